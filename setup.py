@@ -33,6 +33,7 @@ setup(
     [console_scripts]
     flask-ctl = presence_analyzer.script:run
     update-users-data = presence_analyzer.script:update_users_data
+    load-test = presence_analyzer.loadtest:main
 
     [paste.app_factory]
     main = presence_analyzer.script:make_app
@@ -1,6 +1,8 @@
 # -*- coding: utf-8 -*-
 """
 Presence analyzer web app.
+
+The Flask application lives in presence_analyzer.main, importing it
+registers all views. The package itself imports nothing, so that entry
+points in presence_analyzer.script start fast.
 """
-from presence_analyzer.main import app
-from presence_analyzer import views
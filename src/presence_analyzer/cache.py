@@ -0,0 +1,313 @@
+# -*- coding: utf-8 -*-
+"""
+Cache backends shared by DecoratorCache between processes and hosts.
+
+Every backend has the same interface:
+    get(key) - returns value or None when missing or expired,
+    set(key, value, timeout) - stores value,
+    add(key, value, timeout) - stores value only when key is missing,
+        returns True if it was stored, used as a lock,
+    delete(key) - removes value.
+Timeout is in seconds, zero means no expiry.
+
+Values of shared backends are pickled, so they are signed with a secret
+and values with wrong signature are treated as missing, anyone who can
+write to the shared storage could run code on unpickling otherwise.
+"""
+
+import cPickle as pickle
+import errno
+import fcntl
+import hashlib
+import hmac
+import os
+import re
+import socket
+import tempfile
+import time
+import zlib
+from threading import Lock
+
+import logging
+log = logging.getLogger(__name__)  # pylint: disable-msg=C0103
+
+SIGNATURE_SIZE = hashlib.sha256().digest_size
+
+
+def sign(blob, secret):
+    """
+    Returns HMAC-SHA256 signature of blob.
+    """
+    return hmac.new(secret, blob, hashlib.sha256).digest()
+
+
+def serialize(value, secret):
+    """
+    Packs value into compressed binary pickle preceded by its signature.
+    """
+    blob = zlib.compress(pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+    return sign(blob, secret) + blob
+
+
+def deserialize(blob, secret):
+    """
+    Unpacks value packed by serialize.
+
+    Raises ValueError when signature doesn't match, before anything is
+    unpickled.
+    """
+    signature, blob = blob[:SIGNATURE_SIZE], blob[SIGNATURE_SIZE:]
+    if not hmac.compare_digest(signature, sign(blob, secret)):
+        raise ValueError('Wrong signature of cached value.')
+    return pickle.loads(zlib.decompress(blob))
+
+
+def expires(timeout):
+    """
+    Returns time when value with given timeout expires.
+    """
+    return time.time() + timeout if timeout else None
+
+
+class MemoryBackend(object):
+    '''
+    Keeps values in memory of current process.
+    '''
+
+    def __init__(self):
+        """
+        Set empty storage.
+        """
+        self.values = {}
+        self.mutex = Lock()
+
+    def get(self, key):
+        """
+        Returns value or None.
+        """
+        with self.mutex:
+            value, expiry = self.values.get(key, (None, None))
+            if expiry is not None and expiry < time.time():
+                del self.values[key]
+                return None
+            return value
+
+    def set(self, key, value, timeout=0):
+        """
+        Stores value.
+        """
+        with self.mutex:
+            self.values[key] = (value, expires(timeout))
+
+    def add(self, key, value, timeout=0):
+        """
+        Stores value if key is missing.
+        """
+        if self.get(key) is not None:
+            return False
+        with self.mutex:
+            if key in self.values:
+                return False
+            self.values[key] = (value, expires(timeout))
+            return True
+
+    def delete(self, key):
+        """
+        Removes value.
+        """
+        with self.mutex:
+            self.values.pop(key, None)
+
+
+class FileBackend(object):
+    '''
+    Keeps values in files of a directory shared by processes of one host.
+    '''
+
+    def __init__(self, directory, secret):
+        """
+        Set directory, create it if missing, and secret signing values.
+        """
+        self.directory = directory
+        self.secret = secret
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def path(self, key):
+        """
+        Returns file name for key.
+        """
+        return os.path.join(self.directory, re.sub(r'[^\w.-]', '_', key))
+
+    def read(self, path):
+        """
+        Returns (value, expiry) stored in file or None.
+        """
+        try:
+            with open(path, 'rb') as stored:
+                blob = stored.read()
+        except IOError as error:
+            if error.errno != errno.ENOENT:
+                raise
+            return None
+        try:
+            return deserialize(blob, self.secret)
+        except ValueError:
+            log.warning('Ignoring %s, wrong signature.', path)
+            return None
+
+    def get(self, key):
+        """
+        Returns value or None.
+        """
+        entry = self.read(self.path(key))
+        if entry is None:
+            return None
+        value, expiry = entry
+        if expiry is not None and expiry < time.time():
+            return None
+        return value
+
+    def set(self, key, value, timeout=0):
+        """
+        Stores value, readers never see partially written file.
+        """
+        handle, temporary = tempfile.mkstemp(dir=self.directory)
+        with os.fdopen(handle, 'wb') as stored:
+            stored.write(serialize((value, expires(timeout)), self.secret))
+        os.rename(temporary, self.path(key))
+
+    def add(self, key, value, timeout=0):
+        """
+        Stores value if key is missing or expired.
+
+        Processes adding the same key take turns on flock of a guard file,
+        so only one of them takes over an expired value.
+        """
+        path = self.path(key)
+        guard = os.open(path + '.guard', os.O_CREAT | os.O_RDWR)
+        try:
+            fcntl.flock(guard, fcntl.LOCK_EX)
+            if self.get(key) is not None:
+                return False
+            self.set(key, value, timeout)
+            return True
+        finally:
+            os.close(guard)
+
+    def delete(self, key):
+        """
+        Removes value.
+        """
+        try:
+            os.remove(self.path(key))
+        except OSError as error:
+            if error.errno != errno.ENOENT:
+                raise
+
+
+class MemcacheBackend(object):
+    '''
+    Keeps values in memcached server shared by all hosts.
+
+    Speaks memcached text protocol, opens a connection for every
+    operation since they are done only when data expires.
+    '''
+
+    def __init__(self, host, secret, port=11211, socket_timeout=5):
+        """
+        Set server address and secret signing values.
+        """
+        self.address = (host, port)
+        self.secret = secret
+        self.socket_timeout = socket_timeout
+
+    def command(self, line, blob=None):
+        """
+        Sends command, returns first line of response and received value.
+        """
+        connection = socket.create_connection(
+            self.address, self.socket_timeout
+        )
+        try:
+            message = line + '\r\n'
+            if blob is not None:
+                message += blob + '\r\n'
+            connection.sendall(message)
+            response = connection.makefile('rb')
+            try:
+                first = response.readline().rstrip('\r\n')
+                value = None
+                if first.startswith('VALUE '):
+                    value = response.read(int(first.split()[3]))
+            finally:
+                response.close()
+        finally:
+            connection.close()
+        return first, value
+
+    def store(self, command, key, value, timeout):
+        """
+        Sends set or add command, returns True if value was stored.
+        """
+        blob = serialize(value, self.secret)
+        response = self.command(
+            '{0} {1} 0 {2} {3}'.format(command, key, timeout, len(blob)), blob
+        )[0]
+        return response == 'STORED'
+
+    def get(self, key):
+        """
+        Returns value or None.
+        """
+        blob = self.command('get {0}'.format(key))[1]
+        if blob is None:
+            return None
+        try:
+            return deserialize(blob, self.secret)
+        except ValueError:
+            log.warning('Ignoring %s, wrong signature.', key)
+            return None
+
+    def set(self, key, value, timeout=0):
+        """
+        Stores value.
+        """
+        self.store('set', key, value, timeout)
+
+    def add(self, key, value, timeout=0):
+        """
+        Stores value if key is missing.
+        """
+        return self.store('add', key, value, timeout)
+
+    def delete(self, key):
+        """
+        Removes value.
+        """
+        self.command('delete {0}'.format(key))
+
+
+def make_backend(config):
+    """
+    Creates backend selected by CACHE_BACKEND in config.
+
+    Returns None for 'local', caches keep data in their own instance then.
+    Backends shared between processes require CACHE_SECRET.
+    """
+    name = config.get('CACHE_BACKEND', 'local')
+    if name == 'local':
+        return None
+    if name == 'memory':
+        return MemoryBackend()
+    if name not in ('file', 'memcache'):
+        raise ValueError('Unknown cache backend: {0}'.format(name))
+    secret = config.get('CACHE_SECRET')
+    if not secret:
+        raise ValueError('CACHE_SECRET is required by {0} backend.'.format(
+            name
+        ))
+    if name == 'file':
+        return FileBackend(config['CACHE_DIR'], secret)
+    host, _, port = config['CACHE_SERVER'].partition(':')
+    return MemcacheBackend(host, secret, int(port or 11211))
@@ -4,7 +4,12 @@ All decorators.
 """
 
 import datetime
-from threading import Lock
+import time
+from functools import wraps
+from threading import Lock, Thread
+
+import logging
+log = logging.getLogger(__name__)  # pylint: disable-msg=C0103
 
 
 class DecoratorCache(object):
@@ -14,13 +19,169 @@ class DecoratorCache(object):
     data = {}
     last_time = None
     mutex = None
+    worker = None
+    generation = 0
+    key = None
+    built = None
 
-    def __init__(self, sec_timeout=600):
+    def __init__(self, sec_timeout=600, background=False, backend=None,
+                 lock_timeout=60, stale_retry=1):
         """
         Set arg1 and last time value.
+
+        When background is set, expired data is refreshed in a separate
+        thread and callers keep getting the previous value meanwhile.
+        Only the very first call waits for the data.
+
+        When backend (see presence_analyzer.cache) is set, data is shared
+        with other processes through it and only the one holding the lock
+        rebuilds expired data, for at most lock_timeout seconds. Shared
+        data expires timeout after it was built, expired data served
+        meanwhile is checked again every stale_retry seconds.
         """
         self.last_time = datetime.datetime(1970, 1, 1)
         self.sec_timeout = sec_timeout
+        self.background = background
+        self.backend = backend
+        self.lock_timeout = lock_timeout
+        self.stale_retry = stale_retry
+        self.loaded = False
+        self.mutex = Lock()
+
+    def expired(self):
+        """
+        Checks if cached data is older than timeout.
+        """
+        now = datetime.datetime.now()
+        return (now - self.last_time).total_seconds() > self.sec_timeout
+
+    def fetch(self, func):
+        """
+        Reads data from backend, calls function when it is missing or older
+        than timeout and nobody else is rebuilding it.
+
+        Returns data with time it was built at.
+        """
+        entry = self.backend.get(self.key)
+        if entry is not None and \
+                time.time() - entry['built'] <= self.sec_timeout:
+            return entry['data'], entry['built']
+
+        lock = self.key + ':lock'
+        deadline = time.time() + self.lock_timeout
+        acquired = self.backend.add(lock, 1, self.lock_timeout)
+        while not acquired:
+            if entry is not None:
+                # other process rebuilds it, serve old data meanwhile
+                return entry['data'], entry['built']
+            if time.time() > deadline:
+                log.warning('Lock %s not released, rebuilding.', lock)
+                break
+            time.sleep(0.1)
+            entry = self.backend.get(self.key)
+            acquired = entry is None and \
+                self.backend.add(lock, 1, self.lock_timeout)
+        try:
+            return self.build(func)
+        finally:
+            if acquired:
+                self.backend.delete(lock)
+
+    def build(self, func):
+        """
+        Calls function and stores its result in backend.
+        """
+        data = func()
+        built = time.time()
+        self.backend.set(self.key, {'built': built, 'data': data})
+        return data, built
+
+    def load(self, func):
+        """
+        Returns fresh data with time it was built at.
+        """
+        if self.backend is None:
+            return func(), None
+        return self.fetch(func)
+
+    def store(self, data, built):
+        """
+        Replaces cached data and marks when it was checked, new data
+        starts new generation.
+        """
+        now = datetime.datetime.now()
+        self.last_time = now
+        if built is not None:
+            # count from build time, but check expired data again soon
+            self.last_time = max(
+                datetime.datetime.fromtimestamp(built),
+                now - datetime.timedelta(
+                    seconds=self.sec_timeout - self.stale_retry
+                ),
+            )
+        self.loaded = True
+        if built is not None and built == self.built:
+            return
+        self.data = data
+        self.built = built
+        self.generation += 1
+
+    def refresh(self, func):
+        """
+        Calls function and stores its result.
+        """
+        try:
+            data, built = self.load(func)
+        except Exception:  # pylint: disable-msg=W0703
+            log.exception('Background refresh failed, keeping old data.')
+            return
+        with self.mutex:
+            self.store(data, built)
+
+    def snapshot(self):
+        """
+        Returns cached data together with its generation.
+        """
+        with self.mutex:
+            return self.data, self.generation
+
+    def __call__(self, func):
+        """
+        Execute function.
+        """
+
+        @wraps(func)
+        def wrapped_f():
+            with self.mutex:
+                if not self.expired():
+                    return self.data
+                if self.background and self.loaded:
+                    if self.worker is None or not self.worker.is_alive():
+                        self.last_time = datetime.datetime.now()
+                        self.worker = Thread(target=self.refresh, args=(func,))
+                        self.worker.daemon = True
+                        self.worker.start()
+                    return self.data
+                self.store(*self.load(func))
+                return self.data
+        self.key = '{0}.{1}'.format(func.__module__, func.__name__)
+        wrapped_f.cache = self
+        wrapped_f.uncached = func
+        return wrapped_f
+
+
+class DecoratorGeneration(object):
+    '''
+    Compute from data of a cached function once per its generation.
+    '''
+
+    def __init__(self, source):
+        """
+        Set function decorated with DecoratorCache to read data from.
+        """
+        self.source = source
+        self.generation = None
+        self.data = None
         self.mutex = Lock()
 
     def __call__(self, func):
@@ -28,11 +189,14 @@ class DecoratorCache(object):
         Execute function.
         """
 
+        @wraps(func)
         def wrapped_f():
-            now = datetime.datetime.now()
+            self.source()
+            data, generation = self.source.cache.snapshot()
             with self.mutex:
-                if (now - self.last_time).total_seconds() > self.sec_timeout:
-                    self.last_time = datetime.datetime.now()
-                    self.data = func()
+                if generation != self.generation:
+                    self.data = func(data)
+                    self.generation = generation
                 return self.data
+        wrapped_f.cache = self
         return wrapped_f
@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+"""
+Fixed-bucket histograms of times of day.
+"""
+
+
+class Histogram(object):
+    '''
+    Counts values in buckets of fixed width.
+
+    Only non-empty buckets are stored, so a histogram of times of day never
+    has more than 1440 entries at minute resolution no matter how many
+    values were added. Histograms with the same width can be merged.
+    '''
+
+    def __init__(self, width=60):
+        """
+        Set width of bucket in seconds.
+        """
+        self.width = width
+        self.buckets = {}
+        self.count = 0
+
+    def add(self, value, count=1):
+        """
+        Adds value in seconds. Negative values land in the first bucket.
+        """
+        bucket = max(value, 0) // self.width
+        self.buckets[bucket] = self.buckets.get(bucket, 0) + count
+        self.count += count
+
+    def merge(self, other):
+        """
+        Adds counts of other histogram.
+        """
+        if other.width != self.width:
+            raise ValueError('Cannot merge histograms of different width.')
+        for bucket, count in other.buckets.items():
+            self.buckets[bucket] = self.buckets.get(bucket, 0) + count
+        self.count += other.count
+        return self
+
+    def quantile(self, fraction):
+        """
+        Returns lower bound in seconds of bucket with given quantile.
+        Returns zero for empty histograms.
+        """
+        if not self.count:
+            return 0
+        rank = fraction * self.count
+        seen = 0
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+            if seen >= rank:
+                return bucket * self.width
+        return max(self.buckets) * self.width
+
+    def counts(self, width, size):
+        """
+        Returns counts regrouped into size buckets of larger width.
+        Values above last bucket are counted in it.
+        """
+        result = [0] * size
+        for bucket, count in self.buckets.items():
+            result[min(bucket * self.width // width, size - 1)] += count
+        return result
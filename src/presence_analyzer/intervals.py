@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+"""
+Sweep-line computations over presence intervals of many users.
+
+Intervals are turned into events (date, second, change, user_id), where
+change is 1 when the user comes and -1 when the user leaves. Sorted
+events are swept once, keeping number of users present, so every
+computation is O(n log n) for sorting and O(n) after that.
+"""
+
+
+def presence_events(entries):
+    """
+    Returns sorted events of (user_id, date, start, end) entries with
+    start and end in seconds since midnight.
+
+    Leaving is ordered before coming at the same second, so intervals
+    touching each other don't overlap.
+    """
+    events = []
+    for user_id, date, start, end in entries:
+        events.append((date, start, 1, user_id))
+        events.append((date, end, -1, user_id))
+    events.sort(key=lambda event: event[:3])
+    return events
+
+
+def sweep(events):
+    """
+    Yields (date, start, end, count) periods with count users present.
+    """
+    count = 0
+    previous = None
+    for date, moment, change, _ in events:
+        if count and previous is not None and moment > previous:
+            yield date, previous, moment, count
+        count += change
+        previous = moment
+
+
+def overlap(events, user_ids):
+    """
+    Calculates seconds all given users were present together grouped
+    by weekday.
+    """
+    user_ids = set(user_ids)
+    result = {i: 0 for i in range(7)}
+    if not user_ids:
+        return result
+    selected = (event for event in events if event[3] in user_ids)
+    for date, start, end, count in sweep(selected):
+        if count == len(user_ids):
+            result[date.weekday()] += end - start
+    return result
+
+
+def peak_occupancy(events):
+    """
+    Calculates the largest number of users present at once during every
+    hour of day.
+    """
+    result = [0] * 24
+    for _, start, end, count in sweep(events):
+        for hour in range(start // 3600, (end - 1) // 3600 + 1):
+            result[hour] = max(result[hour], count)
+    return result
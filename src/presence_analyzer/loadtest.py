@@ -0,0 +1,368 @@
+# -*- coding: utf-8 -*-
+"""
+Load generator replaying dashboard traffic.
+
+A dashboard session lists users with /api/v2/users and then repeatedly
+asks the chart endpoints about some of them, the /api/v2 DataTable ones
+dashboards use by default. Sessions are replayed by
+concurrent workers either against a running server (bin/load-test --url
+http://localhost:8080) or against the WSGI app in-process, where cache
+expiry can also be forced during the run to measure the cost of
+refreshing data.
+"""
+
+import datetime
+import json
+import random
+import threading
+import time
+
+CHARTS = ('mean_time_weekday', 'presence_weekday', 'presence_start_end')
+
+# Chart endpoints as version/name, dashboards request v2 ones.
+ENDPOINTS = tuple(
+    '{0}/{1}'.format(version, name) for version in ('v1', 'v2')
+    for name in CHARTS
+)
+DEFAULT_MIX = {'v2/{0}'.format(name): 1 for name in CHARTS}
+
+# Requests slower than this many medians are counted as spikes.
+SPIKE_FACTOR = 10
+
+# Requests started this many seconds after forced expiry are reported
+# separately.
+REFRESH_WINDOW = 1.0
+
+
+class InProcessClient(object):
+    '''
+    Sends requests to WSGI app through test clients, one per thread.
+    '''
+
+    def __init__(self, app):
+        """
+        Set application.
+        """
+        self.app = app
+        self.local = threading.local()
+
+    def get(self, path):
+        """
+        Returns status code and body of response.
+        """
+        if not hasattr(self.local, 'client'):
+            self.local.client = self.app.test_client()
+        resp = self.local.client.get(path)
+        return resp.status_code, resp.data
+
+
+class HttpClient(object):
+    '''
+    Sends requests to running server.
+    '''
+
+    def __init__(self, url):
+        """
+        Set server address.
+        """
+        self.url = url.rstrip('/')
+
+    def get(self, path):
+        """
+        Returns status code and body of response.
+        """
+        import urllib2
+        try:
+            resp = urllib2.urlopen(self.url + path)
+        except urllib2.HTTPError as error:
+            return error.code, error.read()
+        try:
+            return resp.getcode(), resp.read()
+        finally:
+            resp.close()
+
+
+def parse_mix(value):
+    """
+    Parses weights of endpoints like
+    'v2/presence_weekday=2,v1/presence_weekday=1'. Endpoints left out are
+    not requested.
+    """
+    mix = {}
+    for item in value.split(','):
+        name, _, weight = item.partition('=')
+        if name not in ENDPOINTS:
+            raise ValueError('Unknown endpoint: {0}'.format(name))
+        mix[name] = float(weight or 1)
+    return mix
+
+
+def choose(rng, mix):
+    """
+    Returns endpoint chosen with its weight.
+    """
+    point = rng.uniform(0, sum(mix.values()))
+    for name in sorted(mix):
+        point -= mix[name]
+        if point <= 0:
+            return name
+    return sorted(mix)[-1]
+
+
+class LoadTest(object):
+    '''
+    Replays dashboard sessions and collects timings of requests.
+    '''
+
+    def __init__(self, client, concurrency=10, sessions=100, users=3,
+                 calls=5, mix=None, seed=None):
+        """
+        Set client and traffic. Every session asks about given number of
+        users, sending calls requests about each of them.
+        """
+        self.client = client
+        self.concurrency = concurrency
+        self.sessions = sessions
+        self.users = users
+        self.calls = calls
+        self.mix = mix or DEFAULT_MIX
+        self.seed = seed
+        self.samples = []
+        self.expiries = []
+        self.mutex = threading.Lock()
+
+    def request(self, path):
+        """
+        Sends request and records (path, start, seconds, status).
+        """
+        start = time.time()
+        status, body = self.client.get(path)
+        seconds = time.time() - start
+        with self.mutex:
+            self.samples.append((path, start, seconds, status))
+        return status, body
+
+    def user_ids(self):
+        """
+        Lists users like dashboard does, falls back to v1 listing.
+        """
+        status, body = self.request('/api/v2/users')
+        if status != 200:
+            status, body = self.request('/api/v1/users')
+        if status != 200:
+            return []
+        return [user['user_id'] for user in json.loads(body)]
+
+    def session(self, rng):
+        """
+        Replays one dashboard session.
+        """
+        user_ids = self.user_ids()
+        if not user_ids:
+            return
+        for _ in range(self.users):
+            user_id = rng.choice(user_ids)
+            for _ in range(self.calls):
+                self.request('/api/{0}/{1}'.format(
+                    choose(rng, self.mix), user_id
+                ))
+
+    def worker(self, number, sessions):
+        """
+        Replays sessions one after another.
+        """
+        rng = random.Random(
+            None if self.seed is None else self.seed + number
+        )
+        for _ in range(sessions):
+            self.session(rng)
+
+    def expire(self, cache, every, done):
+        """
+        Marks cache as expired every given seconds until done is set.
+        """
+        while not done.wait(every):
+            with cache.mutex:
+                cache.last_time = datetime.datetime(1970, 1, 1)
+            self.expiries.append(time.time())
+
+    def run(self, expire_every=None, cache=None):
+        """
+        Runs all sessions and returns report. When expire_every is set,
+        given DecoratorCache is expired that often during the run.
+        """
+        done = threading.Event()
+        expirer = None
+        if expire_every:
+            expirer = threading.Thread(
+                target=self.expire, args=(cache, expire_every, done)
+            )
+            expirer.daemon = True
+            expirer.start()
+
+        start = time.time()
+        workers = []
+        for number in range(self.concurrency):
+            sessions = self.sessions // self.concurrency + \
+                (number < self.sessions % self.concurrency)
+            workers.append(threading.Thread(
+                target=self.worker, args=(number, sessions)
+            ))
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        elapsed = time.time() - start
+
+        done.set()
+        if expirer is not None:
+            expirer.join()
+        return report(self.samples, elapsed, self.expiries)
+
+
+def percentile(values, fraction):
+    """
+    Returns percentile of sorted values, zero for empty list.
+    """
+    if not values:
+        return 0
+    return values[min(int(fraction * len(values)), len(values) - 1)]
+
+
+def summary(seconds):
+    """
+    Returns latency statistics of request times.
+    """
+    seconds = sorted(seconds)
+    return {
+        'requests': len(seconds),
+        'p50': percentile(seconds, 0.5),
+        'p90': percentile(seconds, 0.9),
+        'p99': percentile(seconds, 0.99),
+        'max': seconds[-1] if seconds else 0,
+    }
+
+
+def endpoint(path):
+    """
+    Returns endpoint name of request path, users listings of all versions
+    are counted together.
+    """
+    parts = path.split('/')
+    if parts[3] == 'users':
+        return 'users'
+    return '/'.join(parts[2:4])
+
+
+def report(samples, elapsed, expiries=()):
+    """
+    Calculates throughput, latency percentiles and spikes of samples.
+    """
+    result = summary([sample[2] for sample in samples])
+    result['elapsed'] = elapsed
+    result['throughput'] = len(samples) / elapsed if elapsed else 0
+    result['errors'] = len([
+        sample for sample in samples if sample[3] != 200
+    ])
+    result['spikes'] = len([
+        sample for sample in samples
+        if sample[2] > SPIKE_FACTOR * result['p50']
+    ])
+    result['after_expiry'] = summary([
+        seconds for _, start, seconds, _ in samples
+        if any(0 <= start - expiry <= REFRESH_WINDOW for expiry in expiries)
+    ])
+    result['endpoints'] = {}
+    for name in ('users', ) + ENDPOINTS:
+        result['endpoints'][name] = summary([
+            sample[2] for sample in samples if endpoint(sample[0]) == name
+        ])
+    return result
+
+
+def format_report(result):
+    """
+    Returns report as text table, times in milliseconds.
+    """
+    lines = [
+        'requests: {requests}, errors: {errors}, elapsed: {elapsed:.2f} s, '
+        'throughput: {throughput:.1f} req/s, spikes: {spikes}'.format(
+            **result
+        ),
+        '{0:<24}{1:>10}{2:>10}{3:>10}{4:>10}{5:>10}'.format(
+            '', 'requests', 'p50', 'p90', 'p99', 'max'
+        ),
+    ]
+    rows = [('all', result)]
+    rows += sorted(
+        (name, stats) for name, stats in result['endpoints'].items()
+        if stats['requests']
+    )
+    rows.append(('after expiry', result['after_expiry']))
+    for name, stats in rows:
+        lines.append(
+            '{0:<24}{1:>10}{2:>10.1f}{3:>10.1f}{4:>10.1f}{5:>10.1f}'.format(
+                name, stats['requests'], stats['p50'] * 1000,
+                stats['p90'] * 1000, stats['p99'] * 1000,
+                stats['max'] * 1000,
+            )
+        )
+    return '\n'.join(lines)
+
+
+# bin/load-test ...
+def main(argv=None):
+    """
+    Runs load test from command line.
+    """
+    import argparse
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument(
+        '--url', help='address of running server, in-process app if missing'
+    )
+    parser.add_argument(
+        '--config', default='parts/etc/deploy.cfg',
+        help='config of in-process app'
+    )
+    parser.add_argument('--concurrency', type=int, default=10)
+    parser.add_argument('--sessions', type=int, default=100)
+    parser.add_argument(
+        '--users', type=int, default=3, help='users per session'
+    )
+    parser.add_argument(
+        '--calls', type=int, default=5, help='requests per user'
+    )
+    parser.add_argument(
+        '--mix', type=parse_mix, default=None,
+        help='endpoint weights, like v2/presence_weekday=2,v1/presence_weekday'
+    )
+    parser.add_argument(
+        '--expire-every', type=float, default=None,
+        help='seconds between forced data expiry, in-process only'
+    )
+    parser.add_argument(
+        '--foreground', action='store_true',
+        help='refresh expired data in request threads, in-process only'
+    )
+    parser.add_argument('--seed', type=int, default=None)
+    args = parser.parse_args(argv)
+
+    cache = None
+    if args.url:
+        if args.expire_every or args.foreground:
+            parser.error('--expire-every and --foreground work only '
+                         'in-process')
+        client = HttpClient(args.url)
+    else:
+        from presence_analyzer.script import make_app
+        from presence_analyzer.utils import get_data, get_users_xml
+        client = InProcessClient(make_app(config=args.config))
+        cache = get_data.cache
+        for function in (get_data, get_users_xml):
+            function.cache.background = not args.foreground
+
+    load_test = LoadTest(
+        client, args.concurrency, args.sessions, args.users, args.calls,
+        args.mix, args.seed
+    )
+    print format_report(load_test.run(args.expire_every, cache))
@@ -7,3 +7,6 @@ from flask import Flask
 
 
 app = Flask(__name__)  # pylint: disable-msg=C0103
+
+# Views register their routes on app, so they are imported once it exists.
+import presence_analyzer.views  # noqa, pylint: disable-msg=W0611
@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+"""
+Occupancy cube of users by weekday and quarter-hour of day.
+"""
+
+from array import array
+
+QUARTER = 900
+QUARTERS = 96
+SLICE = 7 * QUARTERS
+
+
+class OccupancyCube(object):
+    '''
+    Dense counts of days every user was present in every quarter-hour
+    of every weekday, with organisation-wide totals.
+
+    Every user has an array of 7 * 96 integers, quarter-hour q of
+    weekday w is at w * 96 + q. Rows are spread over quarter-hours with
+    difference arrays, so a row costs two increments no matter how long
+    it is, and slices are summed up once per update. Arrays of users and
+    totals are kept together in counts attribute as (users, total) pair.
+    Updates build new ones and replace the pair in one assignment, so
+    readers never see them half done or out of step with each other.
+
+    Data the cube was last updated with is kept in data attribute.
+    '''
+
+    def __init__(self):
+        """
+        Set empty cube.
+        """
+        self.counts = ({}, array('i', [0] * SLICE))
+        self.data = {}
+
+    def apply(self, rows):
+        """
+        Adds (user_id, date, start, end, sign) rows with start and end in
+        seconds since midnight to cube, sign -1 removes row added before.
+        """
+        diffs = {}
+        for user_id, date, start, end, sign in rows:
+            first = start // QUARTER
+            last = max(end - 1, start) // QUARTER
+            diff = diffs.get(user_id)
+            if diff is None:
+                diff = diffs[user_id] = [0] * (SLICE + 1)
+            offset = date.weekday() * QUARTERS
+            diff[offset + first] += sign
+            diff[offset + last + 1] -= sign
+
+        users, total = self.counts
+        users = dict(users)
+        total = array('i', total)
+        for user_id, diff in diffs.items():
+            cube = users.get(user_id)
+            if cube is None:
+                cube = array('i', [0] * SLICE)
+            else:
+                cube = array('i', cube)
+            count = 0
+            for i in range(SLICE):
+                count += diff[i]
+                if count:
+                    cube[i] += count
+                    total[i] += count
+            users[user_id] = cube
+        self.counts = users, total
+
+    def weekdays(self, user_id=None):
+        """
+        Returns counts per quarter-hour for every weekday of user, or of
+        all users when user_id is None. Returns None for unknown user.
+        """
+        users, total = self.counts
+        if user_id is None:
+            cube = total
+        else:
+            cube = users.get(user_id)
+            if cube is None:
+                return None
+        return [
+            cube[weekday * QUARTERS:(weekday + 1) * QUARTERS].tolist()
+            for weekday in range(7)
+        ]
@@ -4,12 +4,8 @@
 
 import os
 import sys
-import urllib2
 from functools import partial
 
-import paste.script.command
-import werkzeug.script
-
 etc = partial(os.path.join, 'parts', 'etc')
 
 DEPLOY_INI = etc('deploy.ini')
@@ -26,11 +22,23 @@ abspath = partial(os.path.join, _buildout_path)
 del _buildout_path
 
 
+# Heavy modules (Flask, lxml, paste, werkzeug, urllib2) are imported
+# inside functions below, so that `flask-ctl status` or `update-users-data`
+# load only what they use.
+
+
 # bin/paster serve parts/etc/deploy.ini
 def make_app(global_conf={}, config=DEPLOY_CFG, debug=False):
-    from presence_analyzer import app
+    from presence_analyzer.main import app
+    from presence_analyzer.utils import configure_caches, warm_up
     app.config.from_pyfile(abspath(config))
     app.debug = debug
+    configure_caches(app.config)
+    if app.config.get('WARMUP'):
+        warm_up(
+            background=app.config.get('WARMUP_BACKGROUND', True),
+            retry=app.config.get('WARMUP_RETRY', 30),
+        )
     return app
 
 
@@ -76,11 +84,13 @@ def _serve(action, debug=False, dry_run=False):
         ]
     sys.argv = argv[:2] + [abspath(config)] + argv[3:]
     # Run the 'paster' command
+    import paste.script.command
     paste.script.command.run()
 
 
 # bin/flask-ctl ...
 def run():
+    import werkzeug.script
     action_shell = werkzeug.script.make_shell(make_shell, make_shell.__doc__)
 
     # bin/flask-ctl serve [fg|start|stop|restart|status]
@@ -114,14 +124,30 @@ def run():
     werkzeug.script.run()
 
 
+USERS_XML_TIMEOUT = 30
+
+
 def download_users_xml():
-    #print(abspath(DEBUG_CFG))
-    from presence_analyzer import app
-    app.config.from_pyfile(abspath(DEBUG_CFG))
-    xmlfile = urllib2.urlopen(app.config["USERS_XML_URL"])
-    output = open(abspath('runtime', 'data', 'users.xml'), 'wb')
-    output.write(xmlfile.read())
-    output.close()
+    """Download users.xml next to the old one and swap it in atomically.
+
+    The app refreshes its users cache in the background, so it must never
+    see a half-written file while a slow download is still in progress.
+    """
+    import urllib2
+    config = {}
+    execfile(abspath(DEBUG_CFG), config)
+    xmlfile = urllib2.urlopen(
+        config["USERS_XML_URL"],
+        timeout=config.get('USERS_XML_TIMEOUT', USERS_XML_TIMEOUT),
+    )
+    target = abspath('runtime', 'data', 'users.xml')
+    output = open(target + '.part', 'wb')
+    try:
+        output.write(xmlfile.read())
+    finally:
+        output.close()
+        xmlfile.close()
+    os.rename(target + '.part', target)
 
 
 # bin/update-users-data ...
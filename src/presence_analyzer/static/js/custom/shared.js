@@ -1,10 +1,27 @@
 /**
  * Created by rgatkowski on 03.10.13.
  */
-function parseInterval(value) {
-    var result = new Date(1,1,1);
-    result.setMilliseconds(value*1000);
-    return result;
+function subscribePresence(callback) {
+    if(!window.EventSource) {
+        return;
+    }
+    var source = new EventSource("/api/v1/presence_stream");
+    source.addEventListener("presence", function(event) {
+        callback(JSON.parse(event.data));
+    });
+}
+
+function reloadOnPresenceChange(allUsers) {
+    // Removed users come with null, so check keys rather than values.
+    // When allUsers is set, an empty selection shows all users and any
+    // change reloads it.
+    subscribePresence(function(delta) {
+        var dropdown = $("#user_id");
+        var selected = dropdown.val();
+        if(selected ? selected in delta.users : allUsers) {
+            dropdown.change();
+        }
+    });
 }
 
 google.load("visualization", "1", {packages:["corechart", "timeline"], 'language': 'pl'});
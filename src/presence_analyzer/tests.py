@@ -5,19 +5,49 @@ Presence analyzer unit tests.
 import os.path
 import json
 import datetime
+import shutil
+import SocketServer
+import subprocess
+import sys
+import tempfile
+import threading
+import time
 import unittest
 
-from presence_analyzer import main, utils
+from presence_analyzer import main, views, utils, decorators, histogram, \
+    cache, intervals, loadtest, occupancy  # pylint: disable-msg=W0611
 
 
 TEST_DATA_CSV = os.path.join(
     os.path.dirname(__file__), '..', '..', 'runtime', 'data', 'test_data.csv'
 )
 
+TEST_QUARANTINE_CSV = os.path.join(
+    os.path.dirname(__file__), '..', '..', 'runtime', 'data',
+    'test_quarantine.csv'
+)
+
 TEST_DATA_XML = os.path.join(
     os.path.dirname(__file__), '..', '..', 'runtime', 'data', 'test_users.xml'
 )
 
+TEST_BROKEN_XML = os.path.join(
+    os.path.dirname(__file__), '..', '..', 'runtime', 'data',
+    'test_users_broken.xml'
+)
+
+
+# Seconds allowed for importing entry points module.
+IMPORT_TIME_BUDGET = 0.05
+
+IMPORT_TIME_SCRIPT = """
+import sys, time
+start = time.time()
+import {module}
+print time.time() - start
+print ' '.join(sorted(sys.modules))
+"""
+
 
 # pylint: disable=E1103
 class PresenceAnalyzerViewsTestCase(unittest.TestCase):
@@ -131,6 +161,336 @@ class PresenceAnalyzerViewsTestCase(unittest.TestCase):
         self.assertListEqual(data[1], ['Tue', 34250.0, 58472.0])
         self.assertListEqual(data[2], ['Wed', 31572.0, 60157.0])
 
+    def test_api_presence_stream(self):
+        '''
+        Test stream of presence changes.
+        '''
+        main.app.config.update({'STREAM_TIMEOUT': 0})
+        try:
+            resp = self.client.get('/api/v1/presence_stream', buffered=True)
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(resp.mimetype, 'text/event-stream')
+            self.assertEqual(resp.data, 'retry: 5000\n\n')
+            self.assertEqual(views.STREAMS['open'], 0)
+        finally:
+            del main.app.config['STREAM_TIMEOUT']
+
+    def test_api_presence_stream_delta(self):
+        '''
+        Test users changed in new data generation are sent to stream.
+        '''
+        main.app.config.update({'STREAM_TIMEOUT': 60, 'STREAM_INTERVAL': 0})
+        data = utils.get_data()
+        cache = utils.get_data.cache
+        try:
+            resp = self.client.get('/api/v1/presence_stream')
+            chunks = iter(resp.response)
+            self.assertEqual(next(chunks), 'retry: 0\n\n')
+            self.assertEqual(next(chunks), ': keep-alive\n\n')
+
+            changed = utils.PresenceData(data)
+            changed[99] = {datetime.date(2013, 9, 10): {
+                'start': datetime.time(9, 0, 0),
+                'end': datetime.time(10, 0, 0),
+            }}
+            with cache.mutex:
+                cache.store(changed, None)
+            event = next(chunks).split('\n')
+            self.assertEqual(event[0], 'event: presence')
+            self.assertEqual(json.loads(event[1][len('data: '):]), {
+                'generation': cache.generation,
+                'users': {'99': [0, 3600, 0, 0, 0, 0, 0]},
+            })
+            self.assertEqual(next(chunks), ': keep-alive\n\n')
+
+            with cache.mutex:
+                cache.store(data, None)
+            event = next(chunks).split('\n')
+            self.assertEqual(json.loads(event[1][len('data: '):]), {
+                'generation': cache.generation,
+                'users': {'99': None},
+            })
+            self.assertEqual(views.STREAMS['open'], 1)
+            resp.close()
+            self.assertEqual(views.STREAMS['open'], 0)
+        finally:
+            with cache.mutex:
+                cache.store(data, None)
+            del main.app.config['STREAM_TIMEOUT']
+            del main.app.config['STREAM_INTERVAL']
+
+    def test_api_presence_stream_limit(self):
+        '''
+        Test streams over limit are told to reconnect later.
+        '''
+        main.app.config.update({'STREAM_LIMIT': 1, 'STREAM_INTERVAL': 0})
+        try:
+            first = self.client.get('/api/v1/presence_stream')
+            resp = self.client.get('/api/v1/presence_stream', buffered=True)
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(resp.mimetype, 'text/event-stream')
+            self.assertEqual(resp.data, 'retry: 30000\n\n')
+            first.close()
+
+            resp = self.client.get('/api/v1/presence_stream')
+            self.assertEqual(next(iter(resp.response)), 'retry: 0\n\n')
+            resp.close()
+            self.assertEqual(views.STREAMS['open'], 0)
+        finally:
+            del main.app.config['STREAM_LIMIT']
+            del main.app.config['STREAM_INTERVAL']
+
+    def test_api_presence_percentiles(self):
+        '''
+        Test median and 90th percentile of given user grouped by weekday.
+        '''
+        resp = self.client.get('/api/v1/presence_percentiles/10')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.content_type, 'application/json')
+        data = json.loads(resp.data)
+        self.assertEqual(len(data), 8)
+        self.assertEqual(data[0][0], 'Weekday')
+        self.assertListEqual(data[1], ['Mon', 0, 0, 0, 0, 0, 0])
+        self.assertListEqual(
+            data[2], ['Tue', 33720, 34740, 52140, 64740, 18360, 30000]
+        )
+        resp = self.client.get('/api/v1/presence_percentiles/12')
+        self.assertListEqual(json.loads(resp.data), [])
+
+    def test_api_presence_histogram(self):
+        '''
+        Test number of days by presence hours grouped by weekday.
+        '''
+        resp = self.client.get('/api/v1/presence_histogram/10')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.content_type, 'application/json')
+        data = json.loads(resp.data)
+        self.assertEqual(len(data), 7)
+        self.assertEqual(data[1][0], 'Tue')
+        self.assertEqual(len(data[1][1]), 24)
+        self.assertEqual(data[1][1][5], 1)
+        self.assertEqual(data[1][1][8], 1)
+        self.assertEqual(sum(data[1][1]), 2)
+
+    def test_api_mean_time_weekday_chart(self):
+        '''
+        Test mean presence time grouped by weekday as DataTable.
+        '''
+        resp = self.client.get('/api/v2/mean_time_weekday/10')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.content_type, 'application/json')
+        data = json.loads(resp.data)
+        self.assertListEqual(data['cols'], [
+            {'type': 'string', 'label': 'Weekday'},
+            {'type': 'datetime', 'label': 'Mean time (h:m:s)'},
+        ])
+        self.assertEqual(len(data['rows']), 7)
+        self.assertListEqual(data['rows'][1]['c'], [
+            {'v': 'Tue'},
+            {'v': 'Date(1, 1, 1, 6, 43, 42)', 'f': '06:43:42'},
+        ])
+        resp = self.client.get('/api/v2/mean_time_weekday/12')
+        self.assertListEqual(json.loads(resp.data), [])
+
+    def test_api_presence_weekday_chart(self):
+        '''
+        Test total presence time grouped by weekday as DataTable.
+        '''
+        resp = self.client.get('/api/v2/presence_weekday/10')
+        self.assertEqual(resp.status_code, 200)
+        data = json.loads(resp.data)
+        self.assertEqual(len(data['cols']), 2)
+        self.assertEqual(len(data['rows']), 7)
+        self.assertListEqual(
+            data['rows'][1]['c'], [{'v': 'Tue'}, {'v': 48444}]
+        )
+
+    def test_api_presence_start_end_chart(self):
+        '''
+        Test mean start and end time grouped by weekday as DataTable.
+        '''
+        resp = self.client.get('/api/v2/presence_start_end/10')
+        self.assertEqual(resp.status_code, 200)
+        data = json.loads(resp.data)
+        self.assertEqual(len(data['cols']), 3)
+        self.assertListEqual(data['rows'][1]['c'], [
+            {'v': 'Tue'},
+            {'v': 'Date(1, 1, 1, 9, 30, 50)', 'f': '09:30:50'},
+            {'v': 'Date(1, 1, 1, 16, 14, 32)', 'f': '16:14:32'},
+        ])
+        self.assertIn(('presence_start_end', 10), utils.get_charts())
+
+    def test_api_export_csv(self):
+        '''
+        Test export of presence entries as CSV.
+        '''
+        resp = self.client.get('/api/v1/export?user_id=10&weekday=1')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.mimetype, 'text/csv')
+        self.assertEqual(resp.data, (
+            '10,2013-09-03,09:22:35,14:29:12\n'
+            '10,2013-09-10,09:39:05,17:59:52\n'
+        ))
+
+    def test_api_export_csv_as_data(self):
+        '''
+        Test CSV export is read back as the same data.
+        '''
+        resp = self.client.get('/api/v1/export')
+        handle, path = tempfile.mkstemp()
+        try:
+            with os.fdopen(handle, 'w') as exported:
+                exported.write(resp.data)
+            main.app.config.update({'DATA_CSV': path})
+            data = utils.get_data.uncached()
+        finally:
+            main.app.config.update({'DATA_CSV': TEST_DATA_CSV})
+            os.remove(path)
+        self.assertDictEqual(data, utils.get_data.uncached())
+        self.assertEqual(data.quarantine.report()['categories'], {})
+
+    def test_api_export_ndjson(self):
+        '''
+        Test export of presence entries as newline delimited JSON.
+        '''
+        resp = self.client.get(
+            '/api/v1/export?format=ndjson&from=2013-09-12&to=2013-09-12'
+        )
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.mimetype, 'application/x-ndjson')
+        lines = resp.data.splitlines()
+        self.assertEqual(len(lines), 2)
+        self.assertDictEqual(json.loads(lines[0]), {
+            'user_id': 10,
+            'date': '2013-09-12',
+            'start': '10:48:46',
+            'end': '17:23:51',
+        })
+        self.assertEqual(json.loads(lines[1])['user_id'], 11)
+
+    def test_api_export_errors(self):
+        '''
+        Test export with wrong parameters.
+        '''
+        resp = self.client.get('/api/v1/export?format=xml')
+        self.assertEqual(resp.status_code, 400)
+        resp = self.client.get('/api/v1/export?from=yesterday')
+        self.assertEqual(resp.status_code, 400)
+        resp = self.client.get('/api/v1/export?weekday=7')
+        self.assertEqual(resp.status_code, 400)
+        resp = self.client.get('/api/v1/export?weekday=-1')
+        self.assertEqual(resp.status_code, 400)
+        resp = self.client.get('/api/v1/export?user_id=12&format=ndjson')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.data, '')
+
+    def test_api_quarantine(self):
+        '''
+        Test report of rows rejected on data import.
+        '''
+        resp = self.client.get('/api/v1/admin/quarantine')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.content_type, 'application/json')
+        data = json.loads(resp.data)
+        self.assertDictEqual(
+            data, {'rows': 12, 'accepted': 12, 'categories': {}}
+        )
+
+    def test_healthz(self):
+        '''
+        Test liveness check.
+        '''
+        resp = self.client.get('/healthz')
+        self.assertEqual(resp.status_code, 200)
+        self.assertDictEqual(json.loads(resp.data), {'status': 'ok'})
+
+    def test_readyz(self):
+        '''
+        Test readiness check follows warm-up.
+        '''
+        status = dict(utils.WARMUP_STATUS)
+        try:
+            utils.WARMUP_STATUS.update({'started': True, 'ready': False})
+            resp = self.client.get('/readyz')
+            self.assertEqual(resp.status_code, 503)
+            self.assertFalse(json.loads(resp.data)['ready'])
+            utils.WARMUP_STATUS['ready'] = True
+            resp = self.client.get('/readyz')
+            self.assertEqual(resp.status_code, 200)
+            data = json.loads(resp.data)
+            self.assertTrue(data['ready'])
+            self.assertEqual(
+                data['generation'], utils.get_data.cache.generation
+            )
+        finally:
+            utils.WARMUP_STATUS.update(status)
+
+    def test_api_co_presence(self):
+        '''
+        Test time users were present together grouped by weekday.
+        '''
+        resp = self.client.get('/api/v1/co_presence?users=10,11')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.content_type, 'application/json')
+        data = json.loads(resp.data)
+        self.assertEqual(len(data), 8)
+        self.assertListEqual(data[0], ['Weekday', 'Co-presence (s)'])
+        self.assertListEqual(data[1], ['Mon', 0])
+        self.assertListEqual(data[2], ['Tue', 15409])
+        self.assertListEqual(data[3], ['Wed', 24465])
+        self.assertListEqual(data[4], ['Thu', 44158])
+        self.assertIn(frozenset([10, 11]), utils.get_co_presence())
+        resp = self.client.get('/api/v1/co_presence?users=10')
+        self.assertListEqual(json.loads(resp.data)[2], ['Tue', 48444])
+        resp = self.client.get('/api/v1/co_presence?users=10,x')
+        self.assertEqual(resp.status_code, 400)
+        resp = self.client.get('/api/v1/co_presence')
+        self.assertEqual(resp.status_code, 400)
+
+    def test_api_occupancy(self):
+        '''
+        Test peak number of present users per hour of day.
+        '''
+        resp = self.client.get('/api/v1/occupancy')
+        self.assertEqual(resp.status_code, 200)
+        data = json.loads(resp.data)
+        self.assertEqual(len(data), 25)
+        self.assertListEqual(data[0], ['Hour', 'Peak occupancy'])
+        self.assertListEqual(data[1], ['00:00', 0])
+        self.assertListEqual(data[9], ['08:00', 1])
+        self.assertListEqual(data[10], ['09:00', 2])
+        self.assertListEqual(data[18], ['17:00', 1])
+        self.assertListEqual(data[19], ['18:00', 0])
+
+    def test_heatmap_page(self):
+        """
+        Test presence heatmap page.
+        """
+        resp = self.client.get('/heatmap/')
+        self.assertEqual(resp.status_code, 200)
+
+    def test_api_heatmap(self):
+        '''
+        Test days present per quarter-hour grouped by weekday.
+        '''
+        resp = self.client.get('/api/v1/heatmap/10')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.content_type, 'application/json')
+        data = json.loads(resp.data)
+        self.assertEqual(len(data), 7)
+        self.assertEqual(data[1][0], 'Tue')
+        tuesday = data[1][1]
+        self.assertEqual(len(tuesday), 96)
+        self.assertListEqual(tuesday[36:39], [0, 1, 2])
+        self.assertListEqual(tuesday[57:59], [2, 1])
+        self.assertListEqual(tuesday[71:73], [1, 0])
+        self.assertEqual(sum(data[0][1]), 0)
+        resp = self.client.get('/api/v1/heatmap')
+        data = json.loads(resp.data)
+        self.assertEqual(data[1][1][38], 3)
+        resp = self.client.get('/api/v1/heatmap/12')
+        self.assertListEqual(json.loads(resp.data), [])
+
 
 class PresenceAnalyzerUtilsTestCase(unittest.TestCase):
     """
@@ -231,6 +591,895 @@ class PresenceAnalyzerUtilsTestCase(unittest.TestCase):
             u'avatar': u'https://intranet.stxnext.pl/api/images/users/10'
         })
 
+    def test_get_users_xml_broken(self):
+        '''
+        Test users with wrong id are skipped, missing fields are empty.
+        '''
+        main.app.config.update({'USERS_XML': TEST_BROKEN_XML})
+        data = utils.get_users_xml.uncached()
+        self.assertDictEqual(data, {
+            10: {
+                u'name': u'Maciej Zięba',
+                u'avatar': u'/api/images/users/10',
+            },
+            11: {'name': '', 'avatar': u'/api/images/users/11'},
+        })
+
+    def test_known_user_ids(self):
+        '''
+        Test presence data is read when users XML can't be.
+        '''
+        cache = utils.get_users_xml.cache
+
+        def reset():
+            '''
+            Makes next call read users XML again.
+            '''
+            with cache.mutex:
+                cache.last_time = datetime.datetime(1970, 1, 1)
+                cache.loaded = False
+
+        reset()
+        main.app.config.update({'USERS_XML': None})
+        try:
+            self.assertIsNone(utils.known_user_ids())
+            self.assertIn(10, utils.get_data.uncached())
+        finally:
+            main.app.config.update({'USERS_XML': TEST_DATA_XML})
+            reset()
+        self.assertItemsEqual(
+            utils.known_user_ids(), [141, 176, 170, 10, 11]
+        )
+
+    def test_get_presence_aggregates(self):
+        '''
+        Test total presence per weekday for every user.
+        '''
+        data = utils.get_presence_aggregates()
+        self.assertItemsEqual(data.keys(), [10, 11])
+        self.assertEqual(len(data[10]), 7)
+        self.assertEqual(data[10][1], 48444)
+        self.assertIs(utils.get_presence_aggregates(), data)
+
+    def test_aggregates_delta(self):
+        '''
+        Test only new, changed and removed users are in delta.
+        '''
+        old = {10: [1, 2], 11: [3, 4], 13: [8, 9]}
+        new = {10: [1, 2], 11: [3, 5], 12: [6, 7]}
+        self.assertDictEqual(
+            utils.aggregates_delta(old, new),
+            {11: [3, 5], 12: [6, 7], 13: None}
+        )
+        self.assertDictEqual(utils.aggregates_delta(new, new), {})
+
+    def test_server_sent_event(self):
+        '''
+        Test formatting of event-stream message.
+        '''
+        self.assertEqual(
+            utils.server_sent_event('presence', {'users': {}}),
+            'event: presence\ndata: {"users": {}}\n\n'
+        )
+
+    def test_datatable(self):
+        '''
+        Test building of DataTable JSON structure.
+        '''
+        table = utils.datatable(
+            [('string', 'Name'), ('number', 'Value')],
+            [('a', 1), ('b', (2, 'two'))]
+        )
+        self.assertDictEqual(table, {
+            'cols': [
+                {'type': 'string', 'label': 'Name'},
+                {'type': 'number', 'label': 'Value'},
+            ],
+            'rows': [
+                {'c': [{'v': 'a'}, {'v': 1}]},
+                {'c': [{'v': 'b'}, {'v': 2, 'f': 'two'}]},
+            ],
+        })
+
+    def test_datatable_time(self):
+        '''
+        Test converting seconds to DataTable datetime cell.
+        '''
+        self.assertEqual(
+            utils.datatable_time(36335.4),
+            ('Date(1, 1, 1, 10, 5, 35)', '10:05:35')
+        )
+        self.assertEqual(
+            utils.datatable_time(0), ('Date(1, 1, 1, 0, 0, 0)', '00:00:00')
+        )
+
+    def test_iter_presence(self):
+        '''
+        Test filtering of presence entries.
+        '''
+        data = utils.get_data()
+        entries = utils.iter_presence(data)
+        self.assertNotIsInstance(entries, list)
+        entries = list(entries)
+        self.assertEqual(len(entries), 12)
+        self.assertEqual(entries[0], (
+            10, datetime.date(2013, 9, 3),
+            datetime.time(9, 22, 35), datetime.time(14, 29, 12)
+        ))
+        entries = list(utils.iter_presence(
+            data, user_id=11, since=datetime.date(2013, 9, 10),
+            until=datetime.date(2013, 9, 12), weekday=2
+        ))
+        self.assertListEqual(
+            [entry[1] for entry in entries], [datetime.date(2013, 9, 11)]
+        )
+        self.assertListEqual(list(utils.iter_presence(data, user_id=12)), [])
+
+    def test_get_data_quarantine(self):
+        """
+        Test bad rows are skipped and counted.
+        """
+        main.app.config.update({'DATA_CSV': TEST_QUARANTINE_CSV})
+        data = utils.get_data.uncached()
+        self.assertItemsEqual(data.keys(), [10, 99])
+        self.assertDictEqual(data[10], {datetime.date(2013, 9, 3): {
+            'start': datetime.time(9, 0, 0),
+            'end': datetime.time(17, 0, 0),
+        }})
+        report = data.quarantine.report()
+        self.assertEqual(report['rows'], 6)
+        self.assertEqual(report['accepted'], 2)
+        categories = report['categories']
+        self.assertItemsEqual(
+            categories.keys(),
+            ['malformed', 'duplicate', 'negative', 'unknown_user']
+        )
+        self.assertEqual(categories['malformed']['count'], 2)
+        self.assertDictEqual(categories['negative']['sample'][0], {
+            'line': 3, 'row': ['10', '2013-09-04', '18:00:00', '09:00:00']
+        })
+        self.assertEqual(categories['duplicate']['sample'][0]['line'], 2)
+        self.assertEqual(categories['unknown_user']['sample'][0]['line'], 6)
+
+    def test_quarantine_sample_size(self):
+        """
+        Test number of kept rows is bounded.
+        """
+        quarantine = utils.Quarantine(sample_size=2)
+        for i in range(5):
+            quarantine.add(utils.Quarantine.MALFORMED, i, [])
+        entry = quarantine.report()['categories']['malformed']
+        self.assertEqual(entry['count'], 5)
+        self.assertEqual(len(entry['sample']), 2)
+
+    def test_bounded_cache(self):
+        '''
+        Test least recently used values are dropped over size.
+        '''
+        calls = []
+
+        def build(key):
+            '''
+            Returns builder of value recording its calls.
+            '''
+            def inner():
+                calls.append(key)
+                return key * 2
+            return inner
+
+        store = utils.BoundedCache(2)
+        self.assertEqual(store.get(1, build(1)), 2)
+        self.assertEqual(store.get(2, build(2)), 4)
+        self.assertEqual(store.get(1, build(1)), 2)
+        self.assertEqual(store.get(3, build(3)), 6)
+        self.assertEqual(len(store), 2)
+        self.assertIn(1, store)
+        self.assertNotIn(2, store)
+        self.assertEqual(calls, [1, 2, 3])
+
+    def test_get_user_events(self):
+        '''
+        Test events are grouped by user in order.
+        '''
+        events = utils.get_user_events()
+        self.assertItemsEqual(events.keys(), [10, 11])
+        for user_id, user_events in events.items():
+            self.assertEqual(user_events, [
+                event for event in utils.get_presence_events()
+                if event[3] == user_id
+            ])
+
+    def test_warm_up(self):
+        '''
+        Test all caches are built on warm-up.
+        '''
+        status = dict(utils.WARMUP_STATUS, timings={})
+        try:
+            utils.warm_up(background=True).join()
+            self.assertTrue(utils.WARMUP_STATUS['ready'])
+            self.assertItemsEqual(utils.WARMUP_STATUS['timings'].keys(), [
+                'get_users_xml', 'get_data', 'get_presence_aggregates',
+                'get_histograms', 'get_charts', 'get_presence_events',
+                'get_user_events', 'get_occupancy', 'get_occupancy_cube',
+            ])
+        finally:
+            utils.WARMUP_STATUS.update(status)
+
+    def test_warm_up_retry(self):
+        '''
+        Test failed warm-up is retried until missing file shows up.
+        '''
+        status = dict(utils.WARMUP_STATUS, timings={})
+        cache = utils.get_users_xml.cache
+        utils.WARMUP_STATUS.update({'started': False, 'ready': False})
+        main.app.config.update({'USERS_XML': TEST_DATA_XML + '.missing'})
+        with cache.mutex:
+            cache.last_time = datetime.datetime(1970, 1, 1)
+            cache.loaded = False
+        try:
+            worker = utils.warm_up(background=True, retry=0.01)
+            self.assertTrue(utils.WARMUP_STATUS['started'])
+            while utils.WARMUP_STATUS['error'] is None:
+                time.sleep(0.01)
+            self.assertFalse(utils.WARMUP_STATUS['ready'])
+            self.assertTrue(
+                utils.WARMUP_STATUS['error'].startswith('get_users_xml: ')
+            )
+            self.assertIs(utils.warm_up(background=True, retry=0.01), worker)
+
+            main.app.config.update({'USERS_XML': TEST_DATA_XML})
+            worker.join()
+            self.assertTrue(utils.WARMUP_STATUS['ready'])
+            self.assertIsNone(utils.WARMUP_STATUS['error'])
+        finally:
+            main.app.config.update({'USERS_XML': TEST_DATA_XML})
+            utils.WARMUP_STATUS.update(status)
+
+    def test_warm_up_foreground_failure(self):
+        '''
+        Test failed warm-up in foreground is not retried.
+        '''
+        status = dict(utils.WARMUP_STATUS, timings={})
+        cache = utils.get_users_xml.cache
+        utils.WARMUP_STATUS.update({'started': False, 'ready': False})
+        main.app.config.update({'USERS_XML': TEST_DATA_XML + '.missing'})
+        with cache.mutex:
+            cache.last_time = datetime.datetime(1970, 1, 1)
+            cache.loaded = False
+        try:
+            self.assertIsNone(utils.warm_up(retry=60))
+            self.assertFalse(utils.WARMUP_STATUS['ready'])
+            self.assertTrue(
+                utils.WARMUP_STATUS['error'].startswith('get_users_xml: ')
+            )
+        finally:
+            main.app.config.update({'USERS_XML': TEST_DATA_XML})
+            utils.WARMUP_STATUS.update(status)
+
+    def test_presence_changes(self):
+        '''
+        Test rows turning old presence data into new one.
+        '''
+        monday = datetime.date(2013, 9, 9)
+        tuesday = datetime.date(2013, 9, 10)
+        day = {'start': datetime.time(9, 0, 0), 'end': datetime.time(10, 0, 0)}
+        longer = {'start': datetime.time(9, 0, 0),
+                  'end': datetime.time(11, 0, 0)}
+        old = {10: {monday: day, tuesday: day}}
+        new = {10: {monday: day, tuesday: longer}, 11: {monday: day}}
+        self.assertItemsEqual(list(utils.presence_changes(old, new)), [
+            (10, tuesday, 32400, 36000, -1),
+            (10, tuesday, 32400, 39600, 1),
+            (11, monday, 32400, 36000, 1),
+        ])
+        self.assertListEqual(list(utils.presence_changes(new, new)), [])
+
+
+class PresenceAnalyzerDecoratorsTestCase(unittest.TestCase):
+    """
+    Decorators tests.
+    """
+
+    def test_cache(self):
+        """
+        Test data is read once until timeout.
+        """
+        calls = []
+
+        @decorators.DecoratorCache(600)
+        def load():
+            calls.append(1)
+            return len(calls)
+
+        self.assertEqual(load(), 1)
+        self.assertEqual(load(), 1)
+        self.assertEqual(len(calls), 1)
+
+    def test_cache_background(self):
+        """
+        Test expired data is served while refreshing in background.
+        """
+        calls = []
+
+        @decorators.DecoratorCache(0, background=True)
+        def load():
+            calls.append(1)
+            return len(calls)
+
+        self.assertEqual(load(), 1)
+        load.cache.last_time = datetime.datetime(1970, 1, 1)
+        self.assertEqual(load(), 1)
+        load.cache.worker.join()
+        load.cache.last_time = datetime.datetime.now()
+        load.cache.sec_timeout = 600
+        self.assertEqual(load(), 2)
+
+    def test_cache_background_error(self):
+        """
+        Test failed background refresh keeps old data.
+        """
+        calls = []
+
+        @decorators.DecoratorCache(0, background=True)
+        def load():
+            calls.append(1)
+            if len(calls) > 1:
+                raise IOError()
+            return len(calls)
+
+        self.assertEqual(load(), 1)
+        load.cache.last_time = datetime.datetime(1970, 1, 1)
+        self.assertEqual(load(), 1)
+        load.cache.worker.join()
+        self.assertEqual(load.cache.data, 1)
+        self.assertTrue(load.cache.loaded)
+
+    def test_generation(self):
+        '''
+        Test derived data is computed once per source generation.
+        '''
+        calls = []
+
+        @decorators.DecoratorCache(600)
+        def load():
+            return {'value': 1}
+
+        @decorators.DecoratorGeneration(load)
+        def derived(data):
+            calls.append(1)
+            return data['value'] + 1
+
+        self.assertEqual(derived(), 2)
+        self.assertEqual(derived(), 2)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(load.cache.generation, 1)
+        load.cache.last_time = datetime.datetime(1970, 1, 1)
+        self.assertEqual(derived(), 2)
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(derived.cache.generation, 2)
+
+
+class PresenceAnalyzerHistogramTestCase(unittest.TestCase):
+    """
+    Histogram tests.
+    """
+
+    def test_quantile(self):
+        '''
+        Test quantiles are read from buckets.
+        '''
+        hist = histogram.Histogram()
+        self.assertEqual(hist.quantile(0.5), 0)
+        for value in (30, 90, 150, 610, 615):
+            hist.add(value)
+        self.assertEqual(hist.count, 5)
+        self.assertEqual(hist.quantile(0.5), 120)
+        self.assertEqual(hist.quantile(0.9), 600)
+        self.assertEqual(hist.quantile(1), 600)
+        hist.add(-5)
+        self.assertEqual(hist.buckets[0], 2)
+
+    def test_merge(self):
+        '''
+        Test merging of histograms.
+        '''
+        first = histogram.Histogram()
+        first.add(60)
+        second = histogram.Histogram()
+        second.add(60)
+        second.add(120)
+        first.merge(second)
+        self.assertDictEqual(first.buckets, {1: 2, 2: 1})
+        self.assertEqual(first.count, 3)
+        with self.assertRaises(ValueError):
+            first.merge(histogram.Histogram(1))
+
+    def test_counts(self):
+        '''
+        Test regrouping into larger buckets.
+        '''
+        hist = histogram.Histogram()
+        for value in (0, 3599, 3600, 7200 * 10):
+            hist.add(value)
+        self.assertListEqual(hist.counts(3600, 3), [2, 1, 1])
+
+
+class PresenceAnalyzerImportTestCase(unittest.TestCase):
+    """
+    Import time tests.
+    """
+
+    def import_module(self, module):
+        '''
+        Imports module in new interpreter, returns time and loaded modules.
+        '''
+        env = dict(os.environ)
+        env['PYTHONPATH'] = os.path.join(os.path.dirname(__file__), '..')
+        output = subprocess.check_output(
+            [sys.executable, '-c', IMPORT_TIME_SCRIPT.format(module=module)],
+            env=env
+        )
+        seconds, modules = output.splitlines()
+        return float(seconds), set(modules.split())
+
+    def assertNotImported(self, heavy, modules):
+        '''
+        Fails when any of heavy modules is loaded.
+        '''
+        loaded = [name for name in modules if name.split('.')[0] in heavy]
+        self.assertListEqual(loaded, [])
+
+    def test_import_script(self):
+        '''
+        Test entry points import nothing heavy and fit in time budget.
+        '''
+        seconds, modules = self.import_module('presence_analyzer.script')
+        self.assertNotImported(
+            ['flask', 'lxml', 'paste', 'werkzeug', 'urllib2', 'csv'], modules
+        )
+        self.assertLess(seconds, IMPORT_TIME_BUDGET)
+
+    def test_import_main(self):
+        '''
+        Test importing app registers views, lxml and csv are loaded on
+        first use only.
+        '''
+        modules = self.import_module('presence_analyzer.main')[1]
+        self.assertIn('presence_analyzer.views', modules)
+        self.assertNotImported(['lxml', 'csv'], modules)
+
+    def test_import_views(self):
+        '''
+        Test views can be imported before app.
+        '''
+        modules = self.import_module('presence_analyzer.views')[1]
+        self.assertIn('presence_analyzer.main', modules)
+        self.assertNotImported(['lxml', 'csv'], modules)
+
+    def test_import_utils(self):
+        '''
+        Test utils can be imported before app and views.
+        '''
+        modules = self.import_module('presence_analyzer.utils')[1]
+        self.assertIn('presence_analyzer.utils', modules)
+        self.assertNotImported(['lxml', 'csv'], modules)
+
+
+class FakeMemcacheHandler(SocketServer.StreamRequestHandler):
+    """
+    Answers get, set, add and delete commands of memcached text protocol.
+    """
+
+    def handle(self):
+        """
+        Handles commands sent on connection.
+        """
+        values = self.server.values
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line.split()
+            with self.server.mutex:
+                if command[0] in ('set', 'add'):
+                    blob = self.rfile.read(int(command[4]) + 2)[:-2]
+                    if command[0] == 'add' and command[1] in values:
+                        self.wfile.write('NOT_STORED\r\n')
+                    else:
+                        values[command[1]] = blob
+                        self.wfile.write('STORED\r\n')
+                elif command[0] == 'get':
+                    if command[1] in values:
+                        self.wfile.write('VALUE {0} 0 {1}\r\n{2}\r\n'.format(
+                            command[1], len(values[command[1]]),
+                            values[command[1]]
+                        ))
+                    self.wfile.write('END\r\n')
+                elif command[0] == 'delete':
+                    values.pop(command[1], None)
+                    self.wfile.write('DELETED\r\n')
+
+
+class FakeMemcacheServer(SocketServer.ThreadingTCPServer):
+    """
+    In-process stand-in for memcached server.
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self):
+        """
+        Listen on free local port.
+        """
+        SocketServer.ThreadingTCPServer.__init__(
+            self, ('127.0.0.1', 0), FakeMemcacheHandler
+        )
+        self.values = {}
+        self.mutex = threading.Lock()
+
+
+class PresenceAnalyzerCacheTestCase(unittest.TestCase):
+    """
+    Cache backends tests.
+    """
+
+    def setUp(self):
+        """
+        Before each test, start fake memcached and make cache directory.
+        """
+        self.server = FakeMemcacheServer()
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.directory = tempfile.mkdtemp()
+        self.backends = [
+            cache.MemoryBackend(),
+            cache.FileBackend(os.path.join(self.directory, 'cache'), 'key'),
+            cache.MemcacheBackend(
+                self.server.server_address[0], 'key',
+                self.server.server_address[1]
+            ),
+        ]
+
+    def tearDown(self):
+        """
+        Stop fake memcached and remove cache directory.
+        """
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.directory)
+
+    def test_backends(self):
+        '''
+        Test get, set, add and delete of every backend.
+        '''
+        main.app.config.update({'DATA_CSV': TEST_DATA_CSV})
+        main.app.config.update({'USERS_XML': TEST_DATA_XML})
+        data = utils.get_data.uncached()
+        for backend in self.backends:
+            self.assertIsNone(backend.get('presence.data'))
+            backend.set('presence.data', data)
+            stored = backend.get('presence.data')
+            self.assertDictEqual(stored, data)
+            self.assertEqual(
+                stored.quarantine.report(), data.quarantine.report()
+            )
+            self.assertTrue(backend.add('presence.data:lock', 1, 60))
+            self.assertFalse(backend.add('presence.data:lock', 1, 60))
+            backend.delete('presence.data:lock')
+            self.assertTrue(backend.add('presence.data:lock', 1, 60))
+            backend.delete('presence.data')
+            self.assertIsNone(backend.get('presence.data'))
+
+    def test_expiry(self):
+        '''
+        Test expired locks are taken over.
+        '''
+        for backend in self.backends[:2]:
+            self.assertTrue(backend.add('lock', 1, 1))
+            self.assertFalse(backend.add('lock', 1, 1))
+            time.sleep(1.1)
+            self.assertIsNone(backend.get('lock'))
+            self.assertTrue(backend.add('lock', 1, 1))
+
+    def test_expiry_single_flight(self):
+        '''
+        Test expired lock is taken over by only one of concurrent callers.
+        '''
+        for backend in self.backends[:2]:
+            backend.set('lock', 0, 0.01)
+            time.sleep(0.02)
+            get = backend.get
+
+            def slow_get(key, get=get):
+                '''
+                Lets all callers see expired value before any of them
+                stores a new one.
+                '''
+                value = get(key)
+                time.sleep(0.05)
+                return value
+
+            backend.get = slow_get
+            acquired = []
+            threads = [
+                threading.Thread(
+                    target=lambda: acquired.append(backend.add('lock', 1, 60))
+                ) for _ in range(20)
+            ]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            self.assertEqual(acquired.count(True), 1)
+
+    def test_serialize(self):
+        '''
+        Test values are stored compressed.
+        '''
+        value = {'data': ['x' * 100] * 100}
+        blob = cache.serialize(value, 'key')
+        self.assertLess(len(blob), 200)
+        self.assertEqual(cache.deserialize(blob, 'key'), value)
+
+    def test_signature(self):
+        '''
+        Test values not signed with secret are not unpickled.
+        '''
+        blob = cache.serialize({'data': 1}, 'key')
+        with self.assertRaises(ValueError):
+            cache.deserialize(blob, 'other key')
+        with self.assertRaises(ValueError):
+            cache.deserialize(blob[:-1] + 'x', 'key')
+        for backend in self.backends[1:]:
+            backend.set('presence.data', {'data': 1})
+            self.assertEqual(backend.get('presence.data'), {'data': 1})
+            backend.secret = 'other key'
+            self.assertIsNone(backend.get('presence.data'))
+
+    def test_make_backend(self):
+        '''
+        Test creating backend from config.
+        '''
+        self.assertIsNone(cache.make_backend({}))
+        self.assertIsInstance(
+            cache.make_backend({'CACHE_BACKEND': 'memory'}),
+            cache.MemoryBackend
+        )
+        backend = cache.make_backend({
+            'CACHE_BACKEND': 'memcache', 'CACHE_SERVER': 'cache.local',
+            'CACHE_SECRET': 'key',
+        })
+        self.assertEqual(backend.address, ('cache.local', 11211))
+        self.assertEqual(backend.secret, 'key')
+        with self.assertRaises(ValueError):
+            cache.make_backend({'CACHE_BACKEND': 'redis'})
+        with self.assertRaises(ValueError):
+            cache.make_backend({
+                'CACHE_BACKEND': 'file', 'CACHE_DIR': self.directory
+            })
+
+    def test_shared_cache(self):
+        '''
+        Test only one of processes sharing a backend builds data.
+        '''
+        for backend in self.backends:
+            calls = []
+
+            def load():
+                calls.append(1)
+                return len(calls)
+
+            first = decorators.DecoratorCache(
+                600, backend=backend, stale_retry=0.05
+            )(load)
+            second = decorators.DecoratorCache(
+                600, backend=backend, stale_retry=0.05
+            )(load)
+            self.assertEqual(first(), 1)
+            self.assertEqual(second(), 1)
+            self.assertEqual(len(calls), 1)
+            self.assertEqual(second.cache.generation, 1)
+
+            # data expired while other process is rebuilding it
+            key = first.cache.key
+            backend.set(key, {'built': 0, 'data': 1})
+            backend.add(key + ':lock', 1, 60)
+            second.cache.last_time = datetime.datetime(1970, 1, 1)
+            self.assertEqual(second(), 1)
+            self.assertEqual(len(calls), 1)
+
+            # lock released, data rebuilt once
+            backend.delete(key + ':lock')
+            first.cache.last_time = datetime.datetime(1970, 1, 1)
+            second.cache.last_time = datetime.datetime(1970, 1, 1)
+            self.assertEqual(first(), 2)
+            self.assertEqual(second(), 2)
+            self.assertEqual(len(calls), 2)
+            self.assertEqual(second.cache.built, first.cache.built)
+
+            # stale data served during rebuild is replaced soon after
+            # other process publishes new one
+            backend.set(key, {'built': 0, 'data': 2})
+            backend.add(key + ':lock', 1, 60)
+            second.cache.last_time = datetime.datetime(1970, 1, 1)
+            self.assertEqual(second(), 2)
+            backend.set(key, {'built': time.time(), 'data': 3})
+            backend.delete(key + ':lock')
+            self.assertEqual(second(), 2)
+            time.sleep(0.1)
+            self.assertEqual(second(), 3)
+            self.assertEqual(len(calls), 2)
+            backend.delete(key)
+
+
+class PresenceAnalyzerIntervalsTestCase(unittest.TestCase):
+    """
+    Sweep-line engine tests.
+    """
+
+    def setUp(self):
+        """
+        Before each test, set up events of three users on one Monday.
+        """
+        monday = datetime.date(2013, 9, 9)
+        self.events = intervals.presence_events([
+            (1, monday, 100, 400),
+            (2, monday, 200, 500),
+            (3, monday, 400, 3700),
+        ])
+
+    def test_presence_events(self):
+        '''
+        Test leaving is ordered before coming at the same second.
+        '''
+        self.assertEqual(len(self.events), 6)
+        self.assertListEqual(
+            [event[1:3] for event in self.events],
+            [(100, 1), (200, 1), (400, -1), (400, 1), (500, -1), (3700, -1)]
+        )
+
+    def test_overlap(self):
+        '''
+        Test time of users present together.
+        '''
+        self.assertEqual(intervals.overlap(self.events, [1, 2])[0], 200)
+        self.assertEqual(intervals.overlap(self.events, [2, 3])[0], 100)
+        self.assertEqual(intervals.overlap(self.events, [1, 3])[0], 0)
+        self.assertEqual(intervals.overlap(self.events, [1, 2, 3])[0], 0)
+        self.assertEqual(intervals.overlap(self.events, [3])[0], 3300)
+        self.assertEqual(intervals.overlap(self.events, [])[0], 0)
+        self.assertEqual(intervals.overlap(self.events, [1, 2])[1], 0)
+
+    def test_peak_occupancy(self):
+        '''
+        Test peak number of users present per hour.
+        '''
+        result = intervals.peak_occupancy(self.events)
+        self.assertEqual(len(result), 24)
+        self.assertEqual(result[0], 2)
+        self.assertEqual(result[1], 1)
+        self.assertEqual(result[2], 0)
+
+
+class PresenceAnalyzerLoadTestTestCase(unittest.TestCase):
+    """
+    Load generator tests.
+    """
+
+    def setUp(self):
+        """
+        Before each test, set up a environment.
+        """
+        main.app.config.update({'DATA_CSV': TEST_DATA_CSV})
+        main.app.config.update({'USERS_XML': TEST_DATA_XML})
+
+    def test_run(self):
+        '''
+        Test sessions are replayed in-process during cache expiry.
+        '''
+        load_test = loadtest.LoadTest(
+            loadtest.InProcessClient(main.app), concurrency=2, sessions=3,
+            users=2, calls=2, seed=1
+        )
+        result = load_test.run(expire_every=0.01, cache=utils.get_data.cache)
+        endpoints = result['endpoints']
+        self.assertEqual(len([
+            sample for sample in load_test.samples
+            if sample[0] == '/api/v2/users'
+        ]), 3)
+        self.assertEqual(sum(
+            endpoints['v2/{0}'.format(name)]['requests']
+            for name in loadtest.CHARTS
+        ), 12)
+        self.assertIn(('presence_weekday', 10), utils.get_charts())
+        self.assertGreater(result['throughput'], 0)
+        self.assertLessEqual(result['p50'], result['p99'])
+        self.assertLessEqual(result['p99'], result['max'])
+        self.assertIn('after expiry', loadtest.format_report(result))
+
+    def test_parse_mix(self):
+        '''
+        Test parsing of endpoint weights.
+        '''
+        self.assertDictEqual(
+            loadtest.parse_mix('v2/presence_weekday=2,v1/mean_time_weekday'),
+            {'v2/presence_weekday': 2, 'v1/mean_time_weekday': 1}
+        )
+        with self.assertRaises(ValueError):
+            loadtest.parse_mix('users=1')
+        with self.assertRaises(ValueError):
+            loadtest.parse_mix('presence_weekday=1')
+
+    def test_choose(self):
+        '''
+        Test endpoints without weight are never chosen.
+        '''
+        rng = loadtest.random.Random(1)
+        mix = {'v2/presence_weekday': 1, 'v1/presence_weekday': 0}
+        chosen = set(loadtest.choose(rng, mix) for _ in range(50))
+        self.assertSetEqual(chosen, set(['v2/presence_weekday']))
+
+    def test_report(self):
+        '''
+        Test latency percentiles and spikes.
+        '''
+        samples = [('/api/v1/presence_weekday/10', 100.0, 0.01, 200)] * 98
+        samples += [
+            ('/api/v1/presence_weekday/10', 110.5, 0.5, 200),
+            ('/api/v2/users', 110.6, 0.2, 500),
+        ]
+        result = loadtest.report(samples, 10, expiries=[110])
+        self.assertEqual(result['requests'], 100)
+        self.assertEqual(result['throughput'], 10)
+        self.assertEqual(result['errors'], 1)
+        self.assertEqual(result['spikes'], 2)
+        self.assertEqual(result['p50'], 0.01)
+        self.assertEqual(result['p99'], 0.5)
+        self.assertEqual(result['max'], 0.5)
+        self.assertEqual(result['after_expiry']['requests'], 2)
+        self.assertEqual(result['endpoints']['users']['requests'], 1)
+        self.assertEqual(
+            result['endpoints']['v1/presence_weekday']['requests'], 99
+        )
+        self.assertEqual(
+            result['endpoints']['v2/presence_weekday']['requests'], 0
+        )
+
+
+class PresenceAnalyzerOccupancyTestCase(unittest.TestCase):
+    """
+    Occupancy cube tests.
+    """
+
+    def test_apply(self):
+        '''
+        Test rows are spread over quarter-hours and can be removed.
+        '''
+        cube = occupancy.OccupancyCube()
+        monday = datetime.date(2013, 9, 9)
+        sunday = datetime.date(2013, 9, 15)
+        cube.apply([
+            (1, monday, 900, 2700, 1),
+            (2, monday, 1000, 1000, 1),
+            (2, sunday, 85000, 86399, 1),
+        ])
+        weekdays = cube.weekdays(1)
+        self.assertEqual(len(weekdays), 7)
+        self.assertListEqual(weekdays[0][:4], [0, 1, 1, 0])
+        self.assertListEqual(cube.weekdays(2)[0][:3], [0, 1, 0])
+        self.assertEqual(cube.weekdays(2)[6][95], 1)
+        self.assertListEqual(cube.weekdays()[0][:4], [0, 2, 1, 0])
+        self.assertIsNone(cube.weekdays(3))
+
+        users, total = counts = cube.counts
+        cube.apply([(1, monday, 900, 2700, -1)])
+        self.assertIsNot(cube.counts, counts)
+        self.assertEqual(sum(cube.counts[0][1]), 0)
+        self.assertListEqual(cube.weekdays()[0][:4], [0, 1, 0, 0])
+        self.assertEqual(sum(users[1]), 2)
+        self.assertEqual(sum(total), 5)
+
 
 def suite():
     """
@@ -239,6 +1488,13 @@ def suite():
     suite = unittest.TestSuite()
     suite.addTest(unittest.makeSuite(PresenceAnalyzerViewsTestCase))
     suite.addTest(unittest.makeSuite(PresenceAnalyzerUtilsTestCase))
+    suite.addTest(unittest.makeSuite(PresenceAnalyzerDecoratorsTestCase))
+    suite.addTest(unittest.makeSuite(PresenceAnalyzerHistogramTestCase))
+    suite.addTest(unittest.makeSuite(PresenceAnalyzerImportTestCase))
+    suite.addTest(unittest.makeSuite(PresenceAnalyzerCacheTestCase))
+    suite.addTest(unittest.makeSuite(PresenceAnalyzerIntervalsTestCase))
+    suite.addTest(unittest.makeSuite(PresenceAnalyzerLoadTestTestCase))
+    suite.addTest(unittest.makeSuite(PresenceAnalyzerOccupancyTestCase))
     return suite
 
 
@@ -3,16 +3,19 @@
 Helper functions used in views.
 """
 
-import csv
+import time
+from collections import OrderedDict
 from json import dumps
 from functools import wraps
+from threading import Lock, Thread
 from datetime import datetime
-from lxml import etree
 
 from flask import Response
 
-from presence_analyzer.main import app
-from presence_analyzer.decorators import DecoratorCache
+from presence_analyzer.decorators import DecoratorCache, DecoratorGeneration
+from presence_analyzer.histogram import Histogram
+from presence_analyzer.intervals import presence_events, peak_occupancy
+from presence_analyzer.occupancy import OccupancyCube
 
 import logging
 log = logging.getLogger(__name__)  # pylint: disable-msg=C0103
@@ -29,7 +32,74 @@ def jsonify(function):
     return inner
 
 
-@DecoratorCache(600)
+QUARANTINE_SAMPLE_SIZE = 10
+
+
+class Quarantine(object):
+    """
+    Counts rows rejected or flagged during import and keeps a few of them.
+    """
+    MALFORMED = 'malformed'
+    DUPLICATE = 'duplicate'
+    NEGATIVE = 'negative'
+    UNKNOWN_USER = 'unknown_user'
+
+    def __init__(self, sample_size=QUARANTINE_SAMPLE_SIZE):
+        """
+        Set number of rows kept per category.
+        """
+        self.sample_size = sample_size
+        self.rows = 0
+        self.accepted = 0
+        self.categories = {}
+
+    def add(self, category, line, row):
+        """
+        Records row with given line number in category.
+        """
+        entry = self.categories.setdefault(
+            category, {'count': 0, 'sample': []}
+        )
+        entry['count'] += 1
+        if len(entry['sample']) < self.sample_size:
+            entry['sample'].append({'line': line, 'row': row})
+
+    def report(self):
+        """
+        Returns summary of import.
+        """
+        return {
+            'rows': self.rows,
+            'accepted': self.accepted,
+            'categories': self.categories,
+        }
+
+
+class PresenceData(dict):
+    """
+    Presence data grouped by user_id with quarantine report of its import.
+    """
+
+    def __init__(self, *args, **kwargs):
+        """
+        Set empty quarantine.
+        """
+        super(PresenceData, self).__init__(*args, **kwargs)
+        self.quarantine = Quarantine()
+
+
+def known_user_ids():
+    """
+    Returns ids of users from XML file or None if it can't be read.
+    """
+    try:
+        return set(get_users_xml())
+    except Exception:  # pylint: disable-msg=W0703
+        log.debug('Users XML not available.', exc_info=True)
+        return None
+
+
+@DecoratorCache(600, background=True)
 def get_data():
     """
     Extracts presence data from CSV file and groups it by user_id.
@@ -47,28 +117,50 @@ def get_data():
             },
         }
     }
+
+    Rows which can't be parsed, repeat a date of user or end before they
+    start are skipped. Rows of users missing in users XML are kept.
+    All of them are counted in data.quarantine.
     """
-    data = {}
+    import csv
+    from presence_analyzer.main import app
+    data = PresenceData()
+    quarantine = data.quarantine
+    users = known_user_ids()
     with open(app.config['DATA_CSV'], 'r') as csvfile:
         presence_reader = csv.reader(csvfile, delimiter=',')
-        for i, row in enumerate(presence_reader):
+        for line, row in enumerate(presence_reader, 1):
             if len(row) != 4:
                 # ignore header and footer lines
                 continue
 
+            quarantine.rows += 1
             try:
                 user_id = int(row[0])
                 date = datetime.strptime(row[1], '%Y-%m-%d').date()
                 start = datetime.strptime(row[2], '%H:%M:%S').time()
                 end = datetime.strptime(row[3], '%H:%M:%S').time()
             except (ValueError, TypeError):
-                log.debug('Problem with line %d: ', i, exc_info=True)
+                log.debug('Problem with line %d: ', line, exc_info=True)
+                quarantine.add(Quarantine.MALFORMED, line, row)
+                continue
 
+            if end < start:
+                quarantine.add(Quarantine.NEGATIVE, line, row)
+                continue
+            if date in data.get(user_id, {}):
+                quarantine.add(Quarantine.DUPLICATE, line, row)
+                continue
+            if users is not None and user_id not in users:
+                quarantine.add(Quarantine.UNKNOWN_USER, line, row)
+
+            quarantine.accepted += 1
             data.setdefault(user_id, {})[date] = {'start': start, 'end': end}
 
     return data
 
 
+@DecoratorCache(600, background=True)
 def get_users_xml():
     """
     Extracts users data from XML file and groups it by user_id.
@@ -81,31 +173,33 @@ def get_users_xml():
         }
     }
     """
+    from lxml import etree
+    from presence_analyzer.main import app
     data = {}
     tree = etree.parse(app.config['USERS_XML'])
     try:
         host = tree.xpath("//server/host/text()")[0]
-    except KeyError:
+    except IndexError:
         log.debug('No host in XML file', exc_info=True)
         host = ''
     try:
         protocol = tree.xpath("//server/protocol/text()")[0]
-    except KeyError:
+    except IndexError:
         log.debug('No protocol in XML file', exc_info=True)
         protocol = ''
     for i, user in enumerate(tree.iter('user')):
         try:
             user_id = int(user.get('id'))
-            name = user.find('name').text
-            avatar = user.find('avatar').text
         except (ValueError, TypeError):
-            log.debug('Problem with line %d: ', i, exc_info=True)
-            name = ''
-            avatar = ''
+            log.debug('Problem with user %d: ', i, exc_info=True)
+            continue
+        avatar = user.findtext('avatar', '')
+        if host:
+            avatar = ''.join([protocol, '://', host, avatar])
 
         data[user_id] = {
-            'name': name,
-            'avatar': ''.join([protocol, '://', host, avatar])
+            'name': user.findtext('name', ''),
+            'avatar': avatar,
         }
 
     return data
@@ -155,3 +249,342 @@ def group_by_weekday_with_sec(items):
         result[date.weekday()]["start"].append(seconds_since_midnight(start))
         result[date.weekday()]["end"].append(seconds_since_midnight(end))
     return result
+
+
+@DecoratorGeneration(get_data)
+def get_presence_aggregates(data):
+    """
+    Calculates total presence per weekday for every user.
+
+    Computed once per data generation and shared by all stream clients.
+    It creates structure like this:
+    data = {
+        'user_id': [mon, tue, wed, thu, fri, sat, sun],
+    }
+    """
+    result = {}
+    for user_id, items in data.items():
+        weekdays = group_by_weekday(items)
+        result[user_id] = [sum(weekdays[weekday]) for weekday in range(7)]
+    return result
+
+
+@DecoratorGeneration(get_data)
+def get_histograms(data):
+    """
+    Builds minute resolution histograms of presence for every user.
+
+    Computed once per data generation, so percentiles are read from
+    buckets instead of sorting intervals on every request.
+    It creates structure like this:
+    data = {
+        'user_id': {
+            0: {
+                'start': Histogram(),
+                'end': Histogram(),
+                'duration': Histogram(),
+            },
+        }
+    }
+    """
+    result = {}
+    for user_id, items in data.items():
+        weekdays = result[user_id] = {
+            i: {'start': Histogram(), 'end': Histogram(),
+                'duration': Histogram()}
+            for i in range(7)
+        }
+        for date in items:
+            start = items[date]['start']
+            end = items[date]['end']
+            histograms = weekdays[date.weekday()]
+            histograms['start'].add(seconds_since_midnight(start))
+            histograms['end'].add(seconds_since_midnight(end))
+            histograms['duration'].add(interval(start, end))
+    return result
+
+
+@DecoratorGeneration(get_data)
+def get_charts(data):  # pylint: disable-msg=W0613
+    """
+    Returns storage for chart tables valid for current data generation.
+
+    Tables are added by views on first request and dropped with the data
+    they were made from.
+    """
+    return {}
+
+
+def datatable(columns, rows):
+    """
+    Creates Google Visualization DataTable JSON structure.
+
+    Columns are (type, label) pairs, cells are values or (value, formatted)
+    pairs.
+    """
+    return {
+        'cols': [{'type': type_, 'label': label} for type_, label in columns],
+        'rows': [
+            {'c': [
+                {'v': cell[0], 'f': cell[1]} if isinstance(cell, tuple)
+                else {'v': cell}
+                for cell in row
+            ]} for row in rows
+        ],
+    }
+
+
+def datatable_time(seconds):
+    """
+    Converts seconds since midnight to DataTable datetime cell.
+    """
+    seconds = int(round(seconds))
+    hours, rest = divmod(seconds, 3600)
+    minutes, seconds = divmod(rest, 60)
+    return (
+        'Date(1, 1, 1, {0}, {1}, {2})'.format(hours, minutes, seconds),
+        '{0:02d}:{1:02d}:{2:02d}'.format(hours, minutes, seconds),
+    )
+
+
+def iter_presence(data, user_id=None, since=None, until=None, weekday=None):
+    """
+    Yields (user_id, date, start, end) entries matching given filters
+    ordered by user and date. Filters set to None are not applied.
+    """
+    if user_id is None:
+        user_ids = sorted(data)
+    else:
+        user_ids = [user_id] if user_id in data else []
+    for user in user_ids:
+        items = data[user]
+        for date in sorted(items):
+            if since is not None and date < since:
+                continue
+            if until is not None and date > until:
+                continue
+            if weekday is not None and date.weekday() != weekday:
+                continue
+            yield user, date, items[date]['start'], items[date]['end']
+
+
+@DecoratorGeneration(get_data)
+def get_presence_events(data):
+    """
+    Returns sorted presence events of all users, see intervals module.
+    """
+    return presence_events(
+        (user_id, date, seconds_since_midnight(start),
+         seconds_since_midnight(end))
+        for user_id, date, start, end in iter_presence(data)
+    )
+
+
+@DecoratorGeneration(get_data)
+def get_occupancy(data):  # pylint: disable-msg=W0613
+    """
+    Returns the largest number of users present at once per hour of day.
+    """
+    return peak_occupancy(get_presence_events())
+
+
+@DecoratorGeneration(get_data)
+def get_user_events(data):  # pylint: disable-msg=W0613
+    """
+    Returns sorted presence events grouped by user_id.
+    """
+    result = {}
+    for event in get_presence_events():
+        result.setdefault(event[3], []).append(event)
+    return result
+
+
+CO_PRESENCE_CACHE_SIZE = 1000
+
+
+class BoundedCache(object):
+    """
+    Keeps values of at most size most recently used keys.
+    """
+
+    def __init__(self, size):
+        """
+        Set maximal number of kept values.
+        """
+        self.size = size
+        self.values = OrderedDict()
+        self.mutex = Lock()
+
+    def __contains__(self, key):
+        """
+        Checks if value of key is kept.
+        """
+        with self.mutex:
+            return key in self.values
+
+    def __len__(self):
+        """
+        Returns number of kept values.
+        """
+        with self.mutex:
+            return len(self.values)
+
+    def get(self, key, build):
+        """
+        Returns value of key, calls build to make it when missing.
+        """
+        with self.mutex:
+            if key in self.values:
+                self.values[key] = self.values.pop(key)
+                return self.values[key]
+        value = build()
+        with self.mutex:
+            self.values[key] = value
+            while len(self.values) > self.size:
+                self.values.popitem(last=False)
+        return value
+
+
+@DecoratorGeneration(get_data)
+def get_co_presence(data):  # pylint: disable-msg=W0613
+    """
+    Returns storage for co-presence of user groups valid for current data
+    generation.
+    """
+    return BoundedCache(CO_PRESENCE_CACHE_SIZE)
+
+
+def presence_changes(old, new):
+    """
+    Yields (user_id, date, start, end, sign) rows which turn old presence
+    data into new one, start and end are in seconds since midnight.
+    Sign is 1 for added rows and -1 for removed ones, changed row is
+    removed and added again.
+    """
+    for user_id in set(old) | set(new):
+        before = old.get(user_id, {})
+        after = new.get(user_id, {})
+        if before is after:
+            continue
+        for date in set(before) | set(after):
+            if before.get(date) == after.get(date):
+                continue
+            for items, sign in ((before, -1), (after, 1)):
+                if date in items:
+                    yield (user_id, date,
+                           seconds_since_midnight(items[date]['start']),
+                           seconds_since_midnight(items[date]['end']), sign)
+
+
+OCCUPANCY_CUBE = OccupancyCube()
+
+
+@DecoratorGeneration(get_data)
+def get_occupancy_cube(data):
+    """
+    Returns occupancy cube updated with rows changed since previous data
+    generation.
+    """
+    OCCUPANCY_CUBE.apply(presence_changes(OCCUPANCY_CUBE.data, data))
+    OCCUPANCY_CUBE.data = data
+    return OCCUPANCY_CUBE
+
+
+def aggregates_delta(old, new):
+    """
+    Returns aggregates of users which are new or changed, removed users
+    have None.
+    """
+    result = {
+        user_id: totals
+        for user_id, totals in new.items()
+        if old.get(user_id) != totals
+    }
+    result.update((user_id, None) for user_id in old if user_id not in new)
+    return result
+
+
+def server_sent_event(event, data):
+    """
+    Formats message for text/event-stream response.
+    """
+    return 'event: {0}\ndata: {1}\n\n'.format(event, dumps(data))
+
+
+def configure_caches(config):
+    """
+    Sets backend selected in config on caches of data read from files.
+    """
+    from presence_analyzer.cache import make_backend
+    backend = make_backend(config)
+    for function in (get_data, get_users_xml):
+        function.cache.backend = backend
+
+
+WARMUP_STATUS = {
+    'started': False,
+    'ready': False,
+    'error': None,
+    'timings': {},
+}
+
+
+def build_caches():
+    """
+    Builds all caches, returns False when any of them failed.
+
+    Time of building every cache in seconds is stored in WARMUP_STATUS.
+    """
+    for function in (get_users_xml, get_data, get_presence_aggregates,
+                     get_histograms, get_charts, get_presence_events,
+                     get_user_events, get_occupancy, get_occupancy_cube):
+        start = time.time()
+        try:
+            function()
+        except Exception as error:  # pylint: disable-msg=W0703
+            log.exception('Warm-up of %s failed.', function.__name__)
+            WARMUP_STATUS['error'] = '{0}: {1}'.format(
+                function.__name__, error
+            )
+            return False
+        WARMUP_STATUS['timings'][function.__name__] = time.time() - start
+    WARMUP_STATUS['error'] = None
+    WARMUP_STATUS['ready'] = True
+    return True
+
+
+def retry_build_caches(retry):
+    """
+    Builds all caches again every retry seconds until it succeeds.
+    """
+    while not build_caches() and retry is not None:
+        time.sleep(retry)
+
+
+WARMUP_WORKER = {'thread': None}
+WARMUP_MUTEX = Lock()
+
+
+def warm_up(background=False, retry=None):
+    """
+    Builds all caches before first request.
+
+    In foreground caches are built once, failure is logged and left in
+    WARMUP_STATUS. In background failed warm-up is repeated every retry
+    seconds until it succeeds, so that a missing file doesn't keep the
+    application unready once it shows up. Only one warm-up thread runs
+    at a time, it is returned.
+    """
+    WARMUP_STATUS['started'] = True
+    if not background:
+        build_caches()
+        return None
+
+    with WARMUP_MUTEX:
+        worker = WARMUP_WORKER['thread']
+        if worker is None or not worker.is_alive():
+            worker = Thread(target=retry_build_caches, args=(retry,))
+            worker.daemon = True
+            worker.start()
+            WARMUP_WORKER['thread'] = worker
+        return worker
@@ -4,13 +4,24 @@ Defines views.
 """
 
 import calendar
+import heapq
 import locale
+import time
+from datetime import datetime
+from json import dumps
+from threading import Lock
 
-from flask import redirect, render_template, url_for
+from flask import Response, abort, redirect, render_template, request, \
+    url_for
 
 from presence_analyzer.main import app
 from presence_analyzer.utils import jsonify, get_data, mean, \
-    group_by_weekday, group_by_weekday_with_sec, get_users_xml
+    group_by_weekday, group_by_weekday_with_sec, get_users_xml, \
+    get_presence_aggregates, aggregates_delta, server_sent_event, \
+    get_histograms, get_charts, datatable, datatable_time, iter_presence, \
+    WARMUP_STATUS, get_user_events, get_occupancy, get_co_presence, \
+    get_occupancy_cube
+from presence_analyzer.intervals import overlap
 
 import logging
 log = logging.getLogger(__name__)  # pylint: disable-msg=C0103
@@ -48,6 +59,42 @@ def presence_start_end_view_page():
     return render_template('presence_start_end.html')
 
 
+@app.route('/healthz', methods=['GET'])
+@jsonify
+def healthz_view():
+    """
+    Tells that application process is alive.
+    """
+    return {'status': 'ok'}
+
+
+@app.route('/readyz', methods=['GET'])
+def readyz_view():
+    """
+    Tells if caches are built and application can take traffic.
+
+    Without warm-up caches are built on first request, so it is ready
+    right away.
+    """
+    ready = WARMUP_STATUS['ready'] or not WARMUP_STATUS['started']
+    result = {
+        'ready': ready,
+        'generation': get_data.cache.generation,
+        'timings': WARMUP_STATUS['timings'],
+        'error': WARMUP_STATUS['error'],
+    }
+    return Response(dumps(result), status=200 if ready else 503,
+                    mimetype='application/json')
+
+
+@app.route('/heatmap/')
+def heatmap_view_page():
+    '''
+    Render presence heatmap view
+    '''
+    return render_template('heatmap.html')
+
+
 @app.route('/api/v1/users', methods=['GET'])
 @jsonify
 def users_view():
@@ -144,3 +191,339 @@ def presence_start_end_view(user_id):
         ) for weekday, dates in weekdays.items()]
 
     return result
+
+
+def chart(name, user_id, build):
+    """
+    Returns chart table of given user from cache, builds it when missing.
+    """
+    charts = get_charts()
+    key = (name, user_id)
+    if key not in charts:
+        charts[key] = build(get_data()[user_id])
+    return charts[key]
+
+
+@app.route('/api/v2/mean_time_weekday/<int:user_id>', methods=['GET'])
+@jsonify
+def mean_time_weekday_chart_view(user_id):
+    """
+    Returns mean presence time of given user grouped by weekday
+    as DataTable.
+    """
+    if user_id not in get_data():
+        log.debug('User %s not found!', user_id)
+        return []
+
+    def build(items):
+        """
+        Builds table of mean presence time.
+        """
+        weekdays = group_by_weekday(items)
+        return datatable(
+            [('string', 'Weekday'), ('datetime', 'Mean time (h:m:s)')],
+            [(calendar.day_abbr[weekday], datatable_time(mean(intervals)))
+             for weekday, intervals in weekdays.items()]
+        )
+
+    return chart('mean_time_weekday', user_id, build)
+
+
+@app.route('/api/v2/presence_weekday/<int:user_id>', methods=['GET'])
+@jsonify
+def presence_weekday_chart_view(user_id):
+    """
+    Returns total presence time of given user grouped by weekday
+    as DataTable.
+    """
+    if user_id not in get_data():
+        log.debug('User %s not found!', user_id)
+        return []
+
+    def build(items):
+        """
+        Builds table of total presence time.
+        """
+        weekdays = group_by_weekday(items)
+        return datatable(
+            [('string', 'Weekday'), ('number', 'Presence (s)')],
+            [(calendar.day_abbr[weekday], sum(intervals))
+             for weekday, intervals in weekdays.items()]
+        )
+
+    return chart('presence_weekday', user_id, build)
+
+
+@app.route('/api/v2/presence_start_end/<int:user_id>', methods=['GET'])
+@jsonify
+def presence_start_end_chart_view(user_id):
+    """
+    Returns mean time to come to the office and mean time he leaves
+    as DataTable.
+    """
+    if user_id not in get_data():
+        log.debug('User %s not found!', user_id)
+        return []
+
+    def build(items):
+        """
+        Builds table of mean start and end time.
+        """
+        weekdays = group_by_weekday_with_sec(items)
+        return datatable(
+            [('string', 'Weekday'), ('datetime', 'Start'),
+             ('datetime', 'End')],
+            [(calendar.day_abbr[weekday], datatable_time(mean(dates['start'])),
+              datatable_time(mean(dates['end'])))
+             for weekday, dates in weekdays.items()]
+        )
+
+    return chart('presence_start_end', user_id, build)
+
+
+@app.route('/api/v1/presence_percentiles/<int:user_id>', methods=['GET'])
+@jsonify
+def presence_percentiles_view(user_id):
+    """
+    Returns median and 90th percentile of start, end and presence time
+    of given user grouped by weekday.
+    """
+    histograms = get_histograms()
+    if user_id not in histograms:
+        log.debug('User %s not found!', user_id)
+        return []
+
+    result = [
+        (calendar.day_abbr[weekday],) + tuple(
+            weekdays[name].quantile(fraction)
+            for name in ('start', 'end', 'duration')
+            for fraction in (0.5, 0.9)
+        ) for weekday, weekdays in histograms[user_id].items()]
+
+    result.insert(0, (
+        'Weekday', 'Start median', 'Start p90', 'End median', 'End p90',
+        'Presence median', 'Presence p90'
+    ))
+    return result
+
+
+@app.route('/api/v1/presence_histogram/<int:user_id>', methods=['GET'])
+@jsonify
+def presence_histogram_view(user_id):
+    """
+    Returns number of days by presence time in full hours of given user
+    grouped by weekday.
+    """
+    histograms = get_histograms()
+    if user_id not in histograms:
+        log.debug('User %s not found!', user_id)
+        return []
+
+    result = [
+        (calendar.day_abbr[weekday], weekdays['duration'].counts(3600, 24))
+        for weekday, weekdays in histograms[user_id].items()]
+
+    return result
+
+
+def export_csv(entries):
+    """
+    Yields presence entries as CSV lines in the format of DATA_CSV,
+    without header, so that export can be read back as DATA_CSV.
+    """
+    for user_id, date, start, end in entries:
+        yield '{0},{1},{2},{3}\n'.format(
+            user_id, date.isoformat(), start.isoformat(), end.isoformat()
+        )
+
+
+def export_ndjson(entries):
+    """
+    Yields presence entries as newline delimited JSON objects.
+    """
+    for user_id, date, start, end in entries:
+        yield dumps({
+            'user_id': user_id,
+            'date': date.isoformat(),
+            'start': start.isoformat(),
+            'end': end.isoformat(),
+        }) + '\n'
+
+
+EXPORT_FORMATS = {
+    'csv': (export_csv, 'text/csv'),
+    'ndjson': (export_ndjson, 'application/x-ndjson'),
+}
+
+
+@app.route('/api/v1/export', methods=['GET'])
+def export_view():
+    """
+    Streams presence entries filtered by user_id, from, to (YYYY-MM-DD)
+    and weekday (0 is Monday) as csv or ndjson.
+    """
+    try:
+        writer, mimetype = EXPORT_FORMATS[request.args.get('format', 'csv')]
+        user_id = request.args.get('user_id')
+        if user_id is not None:
+            user_id = int(user_id)
+        weekday = request.args.get('weekday')
+        if weekday is not None:
+            weekday = int(weekday)
+            if not 0 <= weekday <= 6:
+                raise ValueError('Weekday out of range: {0}'.format(weekday))
+        since, until = [
+            datetime.strptime(request.args[name], '%Y-%m-%d').date()
+            if name in request.args else None
+            for name in ('from', 'to')
+        ]
+    except (KeyError, ValueError):
+        log.debug('Wrong export parameters.', exc_info=True)
+        abort(400)
+
+    entries = iter_presence(get_data(), user_id, since, until, weekday)
+    return Response(writer(entries), mimetype=mimetype)
+
+
+@app.route('/api/v1/co_presence', methods=['GET'])
+@jsonify
+def co_presence_view():
+    """
+    Returns time all users given as comma separated ids were present
+    together grouped by weekday.
+    """
+    try:
+        user_ids = frozenset(
+            int(user_id) for user_id in request.args['users'].split(',')
+        )
+    except (KeyError, ValueError):
+        log.debug('Wrong users for co-presence.', exc_info=True)
+        abort(400)
+
+    def build():
+        """
+        Sweeps events of given users only.
+        """
+        events = get_user_events()
+        return overlap(
+            heapq.merge(*[events.get(user_id, []) for user_id in user_ids]),
+            user_ids
+        )
+
+    weekdays = get_co_presence().get(user_ids, build)
+    result = [(calendar.day_abbr[weekday], seconds)
+              for weekday, seconds in weekdays.items()]
+
+    result.insert(0, ('Weekday', 'Co-presence (s)'))
+    return result
+
+
+@app.route('/api/v1/occupancy', methods=['GET'])
+@jsonify
+def occupancy_view():
+    """
+    Returns the largest number of users present at once per hour of day.
+    """
+    result = [('{0:02d}:00'.format(hour), count)
+              for hour, count in enumerate(get_occupancy())]
+
+    result.insert(0, ('Hour', 'Peak occupancy'))
+    return result
+
+
+@app.route('/api/v1/heatmap', methods=['GET'])
+@app.route('/api/v1/heatmap/<int:user_id>', methods=['GET'])
+@jsonify
+def heatmap_view(user_id=None):
+    """
+    Returns number of days given user, or all users, were present in every
+    quarter-hour grouped by weekday.
+    """
+    weekdays = get_occupancy_cube().weekdays(user_id)
+    if weekdays is None:
+        log.debug('User %s not found!', user_id)
+        return []
+
+    return [(calendar.day_abbr[weekday], quarters)
+            for weekday, quarters in enumerate(weekdays)]
+
+
+@app.route('/api/v1/admin/quarantine', methods=['GET'])
+@jsonify
+def quarantine_view():
+    """
+    Returns counts and samples of rows rejected or flagged on data import.
+    """
+    return get_data().quarantine.report()
+
+
+STREAMS = {'open': 0}
+STREAMS_MUTEX = Lock()
+
+
+def open_stream(limit):
+    """
+    Counts stream in, returns False when limit of open streams is reached.
+    """
+    with STREAMS_MUTEX:
+        if STREAMS['open'] >= limit:
+            return False
+        STREAMS['open'] += 1
+        return True
+
+
+def close_stream():
+    """
+    Counts stream out.
+    """
+    with STREAMS_MUTEX:
+        STREAMS['open'] -= 1
+
+
+@app.route('/api/v1/presence_stream', methods=['GET'])
+def presence_stream_view():
+    """
+    Pushes changed presence aggregates to dashboards as server-sent events.
+
+    Every stream holds a server thread, so at most STREAM_LIMIT of them
+    are open at once and each is closed after STREAM_TIMEOUT seconds, the
+    browser reconnects on its own. Over the limit the response only asks
+    to reconnect after STREAM_BUSY_RETRY seconds, as EventSource gives up
+    on 204 and 503 responses.
+    """
+    timeout = app.config.get('STREAM_TIMEOUT', 60)
+    interval = app.config.get('STREAM_INTERVAL', 5)
+    if not open_stream(app.config.get('STREAM_LIMIT', 10)):
+        log.debug('Too many presence streams open.')
+        return Response(
+            'retry: {0}\n\n'.format(
+                app.config.get('STREAM_BUSY_RETRY', 30) * 1000
+            ),
+            mimetype='text/event-stream'
+        )
+
+    def stream():
+        """
+        Sends users whose aggregates changed since last generation.
+        """
+        deadline = time.time() + timeout
+        aggregates = get_presence_aggregates()
+        yield 'retry: {0}\n\n'.format(interval * 1000)
+        while time.time() < deadline:
+            time.sleep(interval)
+            current = get_presence_aggregates()
+            delta = {}
+            if current is not aggregates:
+                delta = aggregates_delta(aggregates, current)
+                aggregates = current
+            if delta:
+                yield server_sent_event('presence', {
+                    'generation': get_presence_aggregates.cache.generation,
+                    'users': delta,
+                })
+            else:
+                yield ': keep-alive\n\n'
+
+    response = Response(stream(), mimetype='text/event-stream')
+    response.call_on_close(close_stream)
+    return response